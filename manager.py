@@ -4,46 +4,82 @@ import configparser
 import subprocess
 import atexit
 import sys
-import readline
 import os
 import time
 import threading
 import queue
 import datetime
+import collections
+import socket
+import http.client
+import json
+import urllib.parse
+import array
+import bisect
+import concurrent.futures
+import glob
+import struct
+import mmap
+import http.server
+import shutil
+import shlex
+import signal
+
+
+HISTORY_PATH = ".command_history"
 
 
-readline.parse_and_bind('tab: complete')
 def complete(text, state):
-    options = ["deploy", "migrate", "show", "remove", "exit", "help"]
+    options = ["deploy", "migrate", "show", "remove", "reprioritize", "reconcile", "rebalance", "jobs", "wait", "cancel",
+               "exit", "help"]
     matches = [opt for opt in options if opt.startswith(text)]
     if state < len(matches):
         return matches[state]
     else:
         return None
-readline.set_completer(complete)
 
 
-readline.parse_and_bind('"\e[A": history-search-backward')
-readline.parse_and_bind('"\e[B": history-search-forward')
-HISTORY_PATH = ".command_history"
-readline.read_history_file(HISTORY_PATH)
+def setup_readline():
+    # line editing and history are only loaded for the interactive CLI
+    import readline
+    readline.parse_and_bind('tab: complete')
+    readline.set_completer(complete)
+    readline.parse_and_bind('"\e[A": history-search-backward')
+    readline.parse_and_bind('"\e[B": history-search-forward')
+    if os.path.exists(HISTORY_PATH):
+        readline.read_history_file(HISTORY_PATH)
+    atexit.register(save_history)
 def add_history(line):
+    import readline
     readline.add_history(line)
 def save_history():
+    import readline
     readline.write_history_file(HISTORY_PATH)
 
-atexit.register(save_history)
+
+# set by exit/quit; on any other way out (crash, Ctrl+C at the prompt) the containers keep
+# running and are recovered from the state journal at the next start
+clean_exit = False
 
 
 def cleanup():
-    message_queue.insert_message("exit")
-    command_remove("node", "all", 1)
+    message_queue.close()
+    if clean_exit:
+        command_remove("node", "all", 1)
+    else:
+        print("Containers are left running and will be recovered at the next start.")
+    standby_pool.drain()
+    if state_journal is not None:
+        state_journal.close()
+    for executor in executors.values():
+        executor.close()
     print("Bye.")
 
 
 class EventList:
-    def __init__(self):
-        self.strings = []
+    # keeps only the most recent `capacity` events
+    def __init__(self, capacity=100):
+        self.strings = collections.deque(maxlen=capacity)
 
     def insert(self, new_string):
         self.strings.append(new_string)
@@ -53,52 +89,438 @@ class EventList:
             print(string)
     
     def clear(self):
-        self.strings = []
+        self.strings.clear()
 
 event_list = EventList()
 
-class ContainerArray:
-    def __init__(self):
-        self.data = []
-    
-    def insert(self, name, priority):
-        self.data.append({'name': name, 'priority': priority})
-    
+
+class Dashboard:
+    # Draws deploy --auto frames (lists of lines) from its own thread, so terminal output
+    # never delays sampling or decisions. Only lines that differ from the screen are rewritten
+    # with ANSI cursor addressing; if drawing falls behind, intermediate frames are skipped.
+    def __init__(self, out):
+        self.out = out
+        self.frame = None
+        self.shown = []
+        self.tty = False
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.frame = None
+        self.shown = []
+        self.tty = self.out.isatty()
+        self.stop_event.clear()
+        if self.tty:
+            self.out.write("\x1b[H\x1b[2J\x1b[?25l")
+            self.out.flush()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="dashboard")
+        self.thread.start()
+
+    def update(self, lines):
+        with self.lock:
+            self.frame = lines
+        self.ready.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.ready.wait()
+            self.ready.clear()
+            with self.lock:
+                frame, self.frame = self.frame, None
+            if frame is not None:
+                self.render(frame)
+
+    def render(self, frame):
+        # lines are cut to the terminal width so that none wraps and shifts the rows below
+        width = shutil.get_terminal_size().columns
+        frame = [line[:width] for line in frame]
+        parts = []
+        for row, line in enumerate(frame):
+            if row >= len(self.shown) or self.shown[row] != line:
+                parts.append(f"\x1b[{row + 1};1H{line}\x1b[K" if self.tty else line + "\n")
+        if self.tty and len(frame) < len(self.shown):
+            parts.append(f"\x1b[{len(frame) + 1};1H\x1b[J")
+        self.shown = frame
+        if len(parts) > 0:
+            self.out.write("".join(parts))
+            self.out.flush()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.ready.set()
+        self.thread.join()
+        self.thread = None
+        if self.tty:
+            self.out.write(f"\x1b[{len(self.shown) + 1};1H\x1b[?25h")
+            self.out.flush()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    # Fixed-bucket latency histogram (seconds) per combination of label values; observe() is a
+    # bisect and three increments under a lock.
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [array.array("q", bytes(8 * (len(LATENCY_BUCKETS) + 1))), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def quantile(self, label_values, q):
+        # upper bound of the bucket that holds the q-quantile
+        with self.lock:
+            counts, total, count = self.series[label_values]
+            rank = q * count
+            seen = 0
+            for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                seen += n
+                if seen >= rank:
+                    return bound
+        return float("inf")
+
+    def summaries(self):
+        with self.lock:
+            items = sorted((label_values, total, count) for label_values, (counts, total, count) in self.series.items())
+        return [(label_values, count, total / count, self.quantile(label_values, 0.5), self.quantile(label_values, 0.99))
+                for label_values, total, count in items if count > 0]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                labels = "".join(f'{label}="{value}",' for label, value in zip(self.labels, label_values))
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {cumulative}')
+                labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+                lines.append(f"{self.name}_sum{labels} {total:.6f}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + 1
+
+    def items(self):
+        with self.lock:
+            return sorted(self.series.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.items():
+            labels = ",".join(f'{label}="{value}"' for label, value in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+ssh_latency = Histogram("container_manager_ssh_seconds", "Round-trip time of commands sent over ssh.", ("host",))
+docker_latency = Histogram("container_manager_docker_seconds", "Latency of docker operations.", ("node", "operation"))
+migration_latency = Histogram("container_manager_migration_seconds", "Duration of complete migrations.", ("kind",))
+queue_wait = Histogram("container_manager_queue_wait_seconds", "Time operations wait in the dispatch queue.")
+sampler_jitter = Histogram("container_manager_sampler_jitter_seconds",
+                           "Deviation of the counter sampling interval from its period.", ("node",))
+migrations_total = Counter("container_manager_migrations_total", "Completed migrations per priority.", ("priority",))
+HISTOGRAMS = [ssh_latency, docker_latency, migration_latency, queue_wait, sampler_jitter]
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    lines += migrations_total.render()
+    lines += ["# HELP container_manager_queue_depth Operations queued or running.",
+              "# TYPE container_manager_queue_depth gauge",
+              f"container_manager_queue_depth {message_queue.depth()}",
+              "# HELP container_manager_operations_superseded_total Queued operations replaced by newer ones.",
+              "# TYPE container_manager_operations_superseded_total counter",
+              f"container_manager_operations_superseded_total {message_queue.superseded}"]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(address, port):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def command_show_stats():
+    print(f"{'METRIC':<28}{'LABELS':<22}{'COUNT':>8}{'MEAN':>12}{'P50 <=':>12}{'P99 <=':>12}")
+    for histogram in HISTOGRAMS:
+        short = histogram.name[len("container_manager_"):]
+        for label_values, count, mean, p50, p99 in histogram.summaries():
+            print(f"{short:<28}{','.join(label_values):<22}{count:>8}{mean * 1000:>10.1f}ms"
+                  f"{p50 * 1000:>10.1f}ms{p99 * 1000:>10.1f}ms")
+    for label_values, value in migrations_total.items():
+        print(f"migrations [{','.join(label_values)}]: {value}")
+    print(f"queue depth: {message_queue.depth()}, superseded: {message_queue.superseded}")
+
+
+PRIORITIES = ["low", "medium", "high"]
+
+
+class ContainerRecord:
+    __slots__ = ("name", "node", "priority")
+
+    def __init__(self, name, node, priority):
+        self.name = name
+        self.node = node
+        self.priority = priority
+
+
+class ContainerRegistry:
+    # Containers of all nodes keyed by name, with secondary indexes by node and by priority.
+    # Every method takes the lock, so the REPL and the dispatcher workers can share it.
+    def __init__(self, nodes):
+        self.lock = threading.RLock()
+        self.records = {}
+        self.by_node = {node: {} for node in nodes}
+        self.by_priority = {priority: {} for priority in PRIORITIES}
+        self.journal = None
+
+    def log(self, entry):
+        # changes are journaled under the lock, so the journal has them in registry order
+        if self.journal is not None:
+            self.journal.append(entry, self)
+
+    def insert(self, name, node, priority):
+        with self.lock:
+            self.unlink(name)
+            record = ContainerRecord(name, node, priority)
+            self.records[name] = record
+            self.by_node.setdefault(node, {})[name] = record
+            self.by_priority.setdefault(priority, {})[name] = record
+            self.log({"op": "set", "name": name, "node": node, "priority": priority})
+            return record
+
+    def get(self, name):
+        with self.lock:
+            return self.records.get(name)
+
     def find(self, name):
-        for item in self.data:
-            if item['name'] == name:
-                return 1
-        return 0
-    
+        with self.lock:
+            record = self.records.get(name)
+            return record.node if record is not None else None
+
+    def get_priority(self, name):
+        with self.lock:
+            record = self.records.get(name)
+            return record.priority if record is not None else None
+
+    def unlink(self, name):
+        record = self.records.pop(name, None)
+        if record is not None:
+            del self.by_node[record.node][name]
+            del self.by_priority[record.priority][name]
+        return record
+
     def delete(self, name):
-        for item in self.data:
-            if item['name'] == name:
-                self.data.remove(item)
-                return 1
-        return 0
-    
-    def clear(self):
-        self.data = []
-    
-    def print_name(self):
-        names = [item['name'] for item in self.data]
-        return ' '.join(names)
-    
-    def get_priority_by_name(self, name):
-        for item in self.data:
-            if item['name'] == name:
-                return item['priority']
-        return None
-    
-    def update_priority_by_name(self, name, new_priority):
-        for item in self.data:
-            if item['name'] == name:
-                item['priority'] = new_priority
-                return 1
-        return 0
-    
-array_node1 = ContainerArray()
-array_node2 = ContainerArray()
+        with self.lock:
+            record = self.unlink(name)
+            if record is not None:
+                self.log({"op": "del", "name": name})
+            return record
+
+    def update_priority(self, name, priority):
+        with self.lock:
+            record = self.records.get(name)
+            if record is None:
+                return False
+            del self.by_priority[record.priority][name]
+            record.priority = priority
+            self.by_priority.setdefault(priority, {})[name] = record
+            self.log({"op": "set", "name": name, "node": record.node, "priority": priority})
+            return True
+
+    def entries(self, node):
+        with self.lock:
+            return [(record.name, record.priority) for record in self.by_node.get(node, {}).values()]
+
+    def names(self, node=None, priority=None):
+        with self.lock:
+            if node is not None:
+                records = self.by_node.get(node, {})
+                if priority is None:
+                    return list(records)
+                return [name for name, record in records.items() if record.priority == priority]
+            if priority is not None:
+                return list(self.by_priority.get(priority, {}))
+            return list(self.records)
+
+    def clear(self, node):
+        with self.lock:
+            names = list(self.by_node.get(node, {}))
+            for name in names:
+                self.delete(name)
+            return names
+
+    def replace_node(self, node, entries):
+        # atomically set the containers of one node to entries [(name, priority)]
+        with self.lock:
+            self.clear(node)
+            for name, priority in entries:
+                self.insert(name, node, priority)
+
+    def snapshot(self):
+        with self.lock:
+            return [(record.name, record.node, record.priority) for record in self.records.values()]
+
+    def __len__(self):
+        return len(self.records)
+
+
+class StateJournal:
+    # Append-only log of registry changes, one JSON object per line, next to a compacted
+    # snapshot. The state is the snapshot with the logged changes applied on top; a torn last
+    # line from a crash is skipped. Every snapshot_every entries the snapshot is rewritten
+    # (temporary file + rename) and the log truncated; replaying a change twice is harmless.
+    def __init__(self, path, snapshot_path, snapshot_every, fsync):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.fd = None
+        self.count = 0
+
+    def load(self):
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                for name, node, priority in json.load(f)["containers"]:
+                    state[name] = (node, priority)
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry["op"] == "set":
+                        state[entry["name"]] = (entry["node"], entry["priority"])
+                    elif entry["op"] == "del":
+                        state.pop(entry["name"], None)
+        return state
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, entry, registry):
+        if self.fd is None:
+            return
+        os.write(self.fd, (json.dumps(entry, separators=(",", ":")) + "\n").encode())
+        if self.fsync:
+            os.fsync(self.fd)
+        self.count += 1
+        if self.count >= self.snapshot_every:
+            self.compact(registry)
+
+    def compact(self, registry):
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"containers": registry.snapshot()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.snapshot_path)
+        if self.fd is not None:
+            os.ftruncate(self.fd, 0)
+        self.count = 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CommandError(RuntimeError):
+    # a docker command failed on a node; timeouts (-1) and lost ssh connections (255) are
+    # worth retrying, anything docker itself refused is not
+    def __init__(self, node, what, result):
+        super().__init__(f"{what} on node [{node}] failed: {result.stderr.decode(errors='replace').strip()}")
+        self.retryable = result.returncode in [-1, 255]
+
+
+# the operation a dispatch worker is running, for checked_call
+dispatch_context = threading.local()
+
+
+def checked_call(node, what, call, applied=None):
+    # Runs one backend call, raising CommandError when it fails. A call that timed out or lost
+    # its ssh connection is retried with exponential backoff, at most job_retries times and not
+    # after job_deadline; applied() is asked first whether the failed attempt took effect after
+    # all, so a create or remove is never done twice.
+    op = getattr(dispatch_context, "op", None)
+    delay = job_backoff
+    deadline = time.monotonic() + job_deadline
+    retries = 0
+    while True:
+        result = call()
+        if result is None or result.ok():
+            return result
+        error = CommandError(node, what, result)
+        if not error.retryable or retries >= job_retries or time.monotonic() + delay > deadline \
+                or (op is not None and op.stopped):
+            raise error
+        time.sleep(delay)
+        delay *= 2
+        retries += 1
+        if op is not None:
+            op.retries += 1
+        if applied is not None and applied():
+            return CommandResult(0, b"", b"", result.latency)
+
+
+def containers_present(node, names):
+    return lambda: set(names) <= set(get_backend(node).list() or {})
+
+
+def containers_absent(node, names):
+    def absent():
+        containers = get_backend(node).list()
+        return containers is not None and len(set(names) & set(containers)) == 0
+    return absent
+
 
 def run_command_no_echo(cmd):
     subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -112,6 +534,580 @@ def run_command(cmd):
     subprocess.run(cmd, shell=True)
 
 
+class CommandResult:
+    def __init__(self, returncode, stdout, stderr, latency):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.latency = latency
+
+    def ok(self):
+        return self.returncode == 0
+
+
+class RemoteExecutor:
+    # All commands for one node share a single ssh master connection (ControlMaster),
+    # so only the first command pays the TCP + ssh handshake.
+    def __init__(self, user, host, control_path, persist, timeout):
+        self.user = user
+        self.host = host
+        self.target = f"{user}@{host}"
+        self.control_path = control_path
+        self.persist = persist
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=1000)
+        self.last_latency = 0.0
+        self.reconnects = 0
+        self.connected = False
+        self.forward_lock = threading.Lock()
+
+    def ssh_args(self):
+        return ["ssh", "-o", "ControlMaster=no", "-o", f"ControlPath={self.control_path}",
+                "-o", "BatchMode=yes", self.target]
+
+    def is_alive(self):
+        cmd = ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "check", self.target]
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return proc.returncode == 0
+
+    def connect(self):
+        with self.lock:
+            if self.is_alive():
+                return True
+            cmd = ["ssh", "-M", "-N", "-f", "-o", "ControlMaster=yes", "-o", f"ControlPath={self.control_path}",
+                   "-o", f"ControlPersist={self.persist}", "-o", "BatchMode=yes",
+                   "-o", "ServerAliveInterval=5", "-o", "ServerAliveCountMax=3", self.target]
+            try:
+                proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            if proc.returncode == 0:
+                self.reconnects += 1
+            self.connected = proc.returncode == 0
+            return self.connected
+
+    def close(self):
+        cmd = ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "exit", self.target]
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.connected = False
+
+    def run(self, cmd, timeout=None, stdin=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.connected:
+            self.connect()
+        result = self._run_once(cmd, timeout, stdin)
+        # ssh exits with 255 when the connection itself failed: reconnect and retry once
+        if result.returncode == 255 and not self.is_alive():
+            if self.connect():
+                result = self._run_once(cmd, timeout, stdin)
+        return result
+
+    def _run_once(self, cmd, timeout, stdin):
+        start = time.monotonic()
+        try:
+            proc = subprocess.run(self.ssh_args() + [cmd], input=stdin, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, timeout=timeout)
+            result = CommandResult(proc.returncode, proc.stdout, proc.stderr, time.monotonic() - start)
+        except subprocess.TimeoutExpired:
+            result = CommandResult(-1, b"", f"timeout after {timeout}s".encode(), time.monotonic() - start)
+        self.last_latency = result.latency
+        self.latencies.append(result.latency)
+        ssh_latency.observe(result.latency, self.host)
+        return result
+
+    def forward_socket(self, local_path, remote_path):
+        if not self.connected:
+            self.connect()
+        if os.path.exists(local_path):
+            os.unlink(local_path)
+        forward = ["-L", f"{local_path}:{remote_path}", self.target]
+        control = ["ssh", "-o", f"ControlPath={self.control_path}", "-O"]
+        try:
+            # a master that still holds the forward would refuse to set it up again
+            subprocess.run(control + ["cancel"] + forward, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           timeout=self.timeout)
+            proc = subprocess.run(control + ["forward"] + forward, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return proc.returncode == 0
+
+    def restore_forward(self, local_path, remote_path):
+        # the forward lives in the master connection, which exits once ControlPersist runs out
+        # without ssh commands (a forward in use does not keep it) or may never have come up:
+        # start the master again and forward anew, unless another caller already did
+        with self.forward_lock:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            probe.settimeout(self.timeout)
+            try:
+                probe.connect(local_path)
+                return True
+            except OSError:
+                pass
+            finally:
+                probe.close()
+            return self.connect() and self.forward_socket(local_path, remote_path)
+
+    def popen(self, cmd, dedicated=False, **kwargs):
+        # dedicated: a connection of its own instead of a channel of the shared master, for
+        # bulk streams that should not share one TCP connection
+        if dedicated:
+            return subprocess.Popen(["ssh", "-o", "ControlPath=none", "-o", "BatchMode=yes", self.target, cmd], **kwargs)
+        if not self.connected:
+            self.connect()
+        return subprocess.Popen(self.ssh_args() + [cmd], **kwargs)
+
+    def print_latency(self):
+        if len(self.latencies) == 0:
+            print(f"[{self.target}] no commands yet.")
+            return
+        samples = sorted(self.latencies)
+        avg = sum(samples) / len(samples)
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        print(f"[{self.target}] commands: {len(samples)}, last: {self.last_latency * 1000:.1f} ms, "
+              f"avg: {avg * 1000:.1f} ms, p99: {p99 * 1000:.1f} ms, reconnects: {self.reconnects}")
+
+
+
+
+def run_local_no_echo(cmd, timeout=None):
+    start = time.monotonic()
+    try:
+        proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return CommandResult(-1, b"", f"timeout after {timeout}s".encode(), time.monotonic() - start)
+    return CommandResult(proc.returncode, proc.stdout, proc.stderr, time.monotonic() - start)
+
+
+def parse_size(size):
+    units = {"b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    size = str(size).strip().lower()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            return f"{size:.2f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+
+
+def container_options(name, cpu, mem):
+    return f"--network host --label {MANAGED_LABEL} --name {name} --cpu-shares {cpu} --memory {mem}"
+
+
+class DockerCLIBackend:
+    # Runs the docker CLI through a command runner (local shell or a RemoteExecutor).
+    def __init__(self, runner):
+        self.runner = runner
+
+    def run_command(self, name, cpu, mem, image):
+        return f"docker run -itd {container_options(name, cpu, mem)} {image}"
+
+    def run(self, name, cpu, mem, image):
+        return self.runner(self.run_command(name, cpu, mem, image))
+
+    def run_paused(self, name, cpu, mem, image):
+        return self.runner(self.run_command(name, cpu, mem, image) + f" >/dev/null && docker pause {name}")
+
+    def claim(self, standby, name):
+        return self.runner(f"docker rename {standby} {name} && docker unpause {name}")
+
+    def run_many(self, specs, image):
+        # all creates of a batch run in parallel inside one shell, i.e. one round-trip; the shell
+        # waits for each of them and fails if any did
+        if len(specs) == 0:
+            return None
+        commands = [self.run_command(name, cpu, mem, image) + ' >/dev/null & pids="$pids $!"' for name, cpu, mem in specs]
+        return self.runner('pids=""; ' + "; ".join(commands) +
+                           "; status=0; for pid in $pids; do wait $pid || status=1; done; exit $status")
+
+    def update(self, name, cpu, mem):
+        return self.runner(f"docker update --cpu-shares {cpu} --memory {mem} {name}")
+
+    def update_many(self, names, cpu, mem):
+        if len(names) == 0:
+            return None
+        return self.runner(f"docker update --cpu-shares {cpu} --memory {mem} " + " ".join(names))
+
+    def list(self):
+        # name -> (cpu shares, running, id) of every managed container, in one command
+        result = self.runner(f"docker ps -aq --filter label={MANAGED_LABEL.split('=')[0]} | xargs -r docker inspect "
+                             "--format '{{.Name}} {{.HostConfig.CpuShares}} {{.State.Running}} {{.Id}}'")
+        if not result.ok():
+            return None
+        containers = {}
+        for line in result.stdout.decode().splitlines():
+            fields = line.split()
+            if len(fields) == 4:
+                containers[fields[0].lstrip("/")] = (int(fields[1]), fields[2] == "true", fields[3])
+        return containers
+
+    def remove(self, names):
+        if len(names) == 0:
+            return None
+        return self.runner("docker rm -f " + " ".join(names))
+
+    def rows(self, cmd):
+        result = self.runner(cmd)
+        if not result.ok():
+            raise RuntimeError(result.stderr.decode().strip())
+        return [tuple(line.split("\t")) for line in result.stdout.decode().splitlines() if line]
+
+    def ps(self):
+        return self.rows("docker ps --format '{{.ID}}\t{{.Image}}\t{{.Status}}\t{{.Names}}'")
+
+    def stats(self):
+        return self.rows("docker stats --no-stream --format '{{.ID}}\t{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.MemPerc}}'")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class DockerAPIClient:
+    # HTTP/1.1 keep-alive connections to dockerd over a unix socket, reused across requests.
+    # reconnect, if given, is called once when the socket is missing or refuses connections
+    # (an ssh forward whose master exited) and returns whether it restored the socket.
+    def __init__(self, socket_path, pool_size=4, timeout=30, api_version="", reconnect=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.prefix = f"/{api_version}" if api_version else ""
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.reconnect = reconnect
+
+    def get_connection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+
+    def put_connection(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, params=None):
+        url = self.prefix + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        reconnected = False
+        for attempt in range(3):
+            conn = self.get_connection()
+            try:
+                conn.request(method, url, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (FileNotFoundError, ConnectionRefusedError):
+                conn.close()
+                if reconnected or self.reconnect is None or not self.reconnect():
+                    raise
+                # pooled connections went through the old socket
+                reconnected = True
+                self.close()
+                continue
+            except (http.client.HTTPException, ConnectionError, BrokenPipeError):
+                # a pooled keep-alive connection may have been closed by dockerd; retry on a fresh one
+                conn.close()
+                if attempt == 2:
+                    raise
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self.put_connection(conn)
+            if response.status >= 400:
+                try:
+                    message = json.loads(data).get("message", "")
+                except ValueError:
+                    message = data.decode(errors="replace")
+                raise DockerAPIError(response.status, message)
+            if data and response.getheader("Content-Type", "").startswith("application/json"):
+                return json.loads(data)
+            return data
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def split_image(ref):
+    # "registry:5000/img:tag" -> ("registry:5000/img", "tag"): a colon before the last "/" belongs
+    # to a registry port; "img@sha256:..." -> ("img", "sha256:...")
+    if "@" in ref:
+        name, _, digest = ref.partition("@")
+        return name, digest
+    name, colon, tag = ref.rpartition(":")
+    if not colon or "/" in tag:
+        return ref, "latest"
+    return name, tag
+
+
+def first_failure(results):
+    # one result for a call made per container: the first failure, else the last result
+    result = None
+    for result in results:
+        if result is not None and not result.ok():
+            return result
+    return result
+
+
+class DockerAPIBackend:
+    # Talks to the Docker Engine API directly instead of forking a shell and the docker CLI.
+    def __init__(self, client):
+        self.client = client
+
+    def call(self, method, path, body=None, params=None):
+        start = time.monotonic()
+        try:
+            data = self.client.request(method, path, body, params)
+            return CommandResult(0, data, b"", time.monotonic() - start)
+        except DockerAPIError as e:
+            return CommandResult(e.status, b"", e.message.encode(), time.monotonic() - start)
+        except OSError as e:
+            return CommandResult(-1, b"", str(e).encode(), time.monotonic() - start)
+
+    def run(self, name, cpu, mem, image):
+        key, _, value = MANAGED_LABEL.partition("=")
+        body = {"Image": image, "Tty": True, "OpenStdin": True, "Labels": {key: value},
+                "HostConfig": {"NetworkMode": "host", "CpuShares": int(cpu), "Memory": parse_size(mem)}}
+        result = self.call("POST", "/containers/create", body, {"name": name})
+        if result.returncode == 404:
+            image_name, tag = split_image(image)
+            self.call("POST", "/images/create", None, {"fromImage": image_name, "tag": tag})
+            result = self.call("POST", "/containers/create", body, {"name": name})
+        if not result.ok():
+            return result
+        return self.call("POST", f"/containers/{name}/start")
+
+    def run_paused(self, name, cpu, mem, image):
+        result = self.run(name, cpu, mem, image)
+        if not result.ok():
+            return result
+        return self.call("POST", f"/containers/{name}/pause")
+
+    def claim(self, standby, name):
+        result = self.call("POST", f"/containers/{standby}/rename", None, {"name": name})
+        if not result.ok():
+            return result
+        return self.call("POST", f"/containers/{name}/unpause")
+
+    def run_many(self, specs, image):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.client.pool.maxsize)) as pool:
+            return first_failure(list(pool.map(lambda spec: self.run(spec[0], spec[1], spec[2], image), specs)))
+
+    def update(self, name, cpu, mem):
+        return self.call("POST", f"/containers/{name}/update", {"CpuShares": int(cpu), "Memory": parse_size(mem)})
+
+    def update_many(self, names, cpu, mem):
+        return first_failure(self.update(name, cpu, mem) for name in names)
+
+    def list(self):
+        filters = json.dumps({"label": [MANAGED_LABEL.split("=")[0]]})
+        result = self.call("GET", "/containers/json", None, {"all": "1", "filters": filters})
+        if not result.ok():
+            return None
+        # /containers/json has no CpuShares, so every container is also inspected; the inspects
+        # run in parallel over the connection pool
+        containers = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.client.pool.maxsize)) as pool:
+            for info in pool.map(lambda c: self.call("GET", f"/containers/{c['Id']}/json"), result.stdout):
+                if info.ok():
+                    containers[info.stdout["Name"].lstrip("/")] = (info.stdout["HostConfig"]["CpuShares"],
+                                                                  info.stdout["State"]["Running"], info.stdout["Id"])
+        return containers
+
+    def remove(self, names):
+        # like `docker rm -f`, a container that is already gone counts as removed
+        results = [self.call("DELETE", f"/containers/{name}", None, {"force": "1"}) for name in names]
+        return first_failure(result for result in results if result.returncode != 404)
+
+    def ps(self):
+        result = self.call("GET", "/containers/json")
+        if not result.ok():
+            raise RuntimeError(result.stderr.decode())
+        return [(c["Id"][:12], c["Image"], c["Status"], ",".join(n.lstrip("/") for n in c["Names"]))
+                for c in result.stdout]
+
+    def container_stats(self, container_id):
+        s = self.call("GET", f"/containers/{container_id}/stats", None, {"stream": "0"}).stdout
+        if not s:
+            return None
+        cpu_delta = s["cpu_stats"]["cpu_usage"]["total_usage"] - s["precpu_stats"]["cpu_usage"]["total_usage"]
+        system_delta = s["cpu_stats"].get("system_cpu_usage", 0) - s["precpu_stats"].get("system_cpu_usage", 0)
+        online = s["cpu_stats"].get("online_cpus", 1)
+        cpu = cpu_delta / system_delta * online * 100 if system_delta > 0 else 0.0
+        usage = s["memory_stats"].get("usage", 0)
+        limit = s["memory_stats"].get("limit", 0)
+        mem = usage / limit * 100 if limit else 0.0
+        return (container_id[:12], s["name"].lstrip("/"), f"{cpu:.2f}%",
+                f"{format_size(usage)} / {format_size(limit)}", f"{mem:.2f}%")
+
+    def stats(self):
+        result = self.call("GET", "/containers/json")
+        if not result.ok():
+            raise RuntimeError(result.stderr.decode())
+        ids = [c["Id"] for c in result.stdout]
+        if len(ids) == 0:
+            return []
+        # each stats call waits for a second CPU sample, so query the containers in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ids), 16)) as pool:
+            return [row for row in pool.map(self.container_stats, ids) if row is not None]
+
+
+class SimulatedBackend:
+    # Stand-in for a node in replay mode: containers only exist in memory and every docker
+    # operation sleeps for its configured latency, divided by the replay speed.
+    def __init__(self, latencies, speed):
+        self.latencies = latencies
+        self.speed = speed
+        self.containers = {}
+        self.lock = threading.Lock()
+
+    def call(self, kind):
+        latency = self.latencies[kind]
+        time.sleep(latency / self.speed)
+        return CommandResult(0, b"", b"", latency)
+
+    def run(self, name, cpu, mem, image):
+        with self.lock:
+            self.containers[name] = (int(cpu), True, name)
+        return self.call("run")
+
+    def run_paused(self, name, cpu, mem, image):
+        with self.lock:
+            self.containers[name] = (int(cpu), False, name)
+        return self.call("run")
+
+    def claim(self, standby, name):
+        with self.lock:
+            cpu, running, container_id = self.containers.pop(standby)
+            self.containers[name] = (cpu, True, container_id)
+        return self.call("update")
+
+    def run_many(self, specs, image):
+        if len(specs) == 0:
+            return None
+        with self.lock:
+            for name, cpu, mem in specs:
+                self.containers[name] = (int(cpu), True, name)
+        return self.call("run")
+
+    def update(self, name, cpu, mem):
+        return self.update_many([name], cpu, mem)
+
+    def update_many(self, names, cpu, mem):
+        if len(names) == 0:
+            return None
+        with self.lock:
+            for name in names:
+                if name in self.containers:
+                    self.containers[name] = (int(cpu),) + self.containers[name][1:]
+        return self.call("update")
+
+    def list(self):
+        self.call("list")
+        with self.lock:
+            return dict(self.containers)
+
+    def remove(self, names):
+        if len(names) == 0:
+            return None
+        with self.lock:
+            for name in names:
+                self.containers.pop(name, None)
+        return self.call("remove")
+
+    def ps(self):
+        with self.lock:
+            return [(name[:12], image, "Up" if running else "Paused", name)
+                    for name, (cpu, running, container_id) in self.containers.items()]
+
+    def stats(self):
+        with self.lock:
+            return [(name[:12], name, "0.00%", "0B / 0B", "0.00%") for name in self.containers]
+
+
+class TimedBackend:
+    # Wraps the backend of a node and records the latency of every docker operation it runs.
+    OPERATIONS = {"run": "run", "run_paused": "run", "run_many": "run", "claim": "claim", "update": "update",
+                  "update_many": "update", "remove": "rm", "list": "list"}
+
+    def __init__(self, node, backend):
+        self.node = node
+        self.backend = backend
+
+    def __getattr__(self, attr):
+        method = getattr(self.backend, attr)
+        operation = self.OPERATIONS.get(attr)
+        if operation is None:
+            return method
+
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            result = method(*args, **kwargs)
+            # None: nothing to do (e.g. an empty batch), no docker call was made
+            if result is not None:
+                docker_latency.observe(time.monotonic() - start, self.node, operation)
+            return result
+        return timed
+
+
+MANAGED_LABEL = "container_manager=1"
+
+
+def create_backend(node):
+    executor = executors.get(node)
+    if docker_backend == "api":
+        if executor is None:
+            return DockerAPIBackend(DockerAPIClient(docker_socket, docker_pool_size, float(config["ssh_timeout"]),
+                                                    docker_api_version))
+        # a forward that fails here, or goes away later, is set up again by the first call that finds it missing
+        socket_path = docker_forward_socket.format(node=node)
+        executor.forward_socket(socket_path, docker_remote_socket)
+        return DockerAPIBackend(DockerAPIClient(socket_path, docker_pool_size, float(config["ssh_timeout"]),
+                                                docker_api_version,
+                                                lambda: executor.restore_forward(socket_path, docker_remote_socket)))
+    if executor is None:
+        return DockerCLIBackend(lambda cmd: run_local_no_echo(cmd, float(config["ssh_timeout"])))
+    return DockerCLIBackend(executor.run)
+
+
+def get_backend(node):
+    return backends[node]
+
+
 def read_config():
     config = configparser.ConfigParser()
     config.read("config.ini")
@@ -123,24 +1119,138 @@ def read_config():
 
     remote_host = connection.get("remote_host")
     remote_user = connection.get("remote_user")
+    docker = config["docker"] if config.has_section("docker") else {}
+    docker_backend = docker.get("backend", "cli")
+    docker_socket = docker.get("socket", "/var/run/docker.sock")
+    docker_remote_socket = docker.get("remote_socket", "/var/run/docker.sock")
+    docker_forward_socket = docker.get("forward_socket", "/tmp/container_manager-node{node}-docker.sock")
+    docker_pool_size = docker.get("pool_size", "4")
+    docker_api_version = docker.get("api_version", "")
+    ssh_control_path = connection.get("ssh_control_path", "/tmp/container_manager-%r@%h:%p")
+    ssh_persist = connection.get("ssh_persist", "600")
+    ssh_timeout = connection.get("ssh_timeout", "30")
     local_interface = network.get("local_interface")
     remote_interface = network.get("remote_interface")
+    # nodes come from [node:ID] sections; without them node 1 is this host and node 2 is [connection]
+    nodes = {}
+    for section in config.sections():
+        if section.startswith("node:"):
+            node = config[section]
+            nodes[section[len("node:"):]] = {"host": node.get("host", "local"), "user": node.get("user", remote_user),
+                                             "interface": node.get("interface")}
+    if len(nodes) == 0:
+        nodes["1"] = {"host": "local", "user": None, "interface": local_interface}
+        nodes["2"] = {"host": remote_host, "user": remote_user, "interface": remote_interface}
     throughput_low = network.get("throughput_low")
     throughput_medium = network.get("throughput_medium")
     throughput_high = network.get("throughput_high")
+    strategy = config["strategy"] if config.has_section("strategy") else {}
+    smoothing = strategy.get("smoothing", "none")
+    ewma_alpha = strategy.get("ewma_alpha", "0.3")
+    smoothing_window = strategy.get("window", "3")
+    smoothing_percentile = strategy.get("percentile", "50")
+    hysteresis = strategy.get("hysteresis", "0")
+    min_dwell = strategy.get("min_dwell", "0")
+    record = config["record"] if config.has_section("record") else {}
+    record_path = record.get("path", "")
+    record_max_bytes = record.get("max_bytes", "16777216")
+    record_keep = record.get("keep", "4")
+    state = config["state"] if config.has_section("state") else {}
+    state_journal = state.get("journal", "")
+    state_snapshot = state.get("snapshot", "state.snapshot")
+    state_snapshot_every = state.get("snapshot_every", "1000")
+    state_fsync = state.get("fsync", "no")
+    capacity = config["capacity"] if config.has_section("capacity") else {}
+    capacity_nodes = {node: (int(capacity["cpu_" + node]) if "cpu_" + node in capacity else None,
+                             parse_size(capacity["memory_" + node]) if "memory_" + node in capacity else None)
+                      for node in nodes}
+    cpu_overcommit = capacity.get("cpu_overcommit", "2")
+    memory_overcommit = capacity.get("memory_overcommit", "1")
+    rebalance_moves = capacity.get("rebalance_moves", "2")
+    dashboard = config["dashboard"] if config.has_section("dashboard") else {}
+    dashboard_events = dashboard.get("events", "20")
+    stats = config["stats"] if config.has_section("stats") else {}
+    stats_address = stats.get("address", "127.0.0.1")
+    stats_port = int(stats.get("port", "0"))
+    replay = config["replay"] if config.has_section("replay") else {}
+    replay_speed = replay.get("speed", "100")
+    replay_duration = replay.get("duration", "120")
+    replay_latencies = {kind: float(replay.get(f"{kind}_latency", default))
+                        for kind, default in [("run", "0.5"), ("update", "0.05"), ("remove", "0.2"), ("list", "0.05")]}
+    replay_patterns = {}
+    for key, value in replay.items():
+        if key.startswith("traffic_"):
+            points = [point.strip().split("@") for point in value.split(",")]
+            replay_patterns[key[len("traffic_"):]] = sorted((float(t), float(rate)) for rate, t in points)
+    forecast = config["forecast"] if config.has_section("forecast") else {}
+    forecast_method = forecast.get("method", "off")
+    forecast_window = forecast.get("window", "20")
+    forecast_lead_time = forecast.get("lead_time", "2")
+    forecast_alpha = forecast.get("alpha", "0.5")
+    forecast_beta = forecast.get("beta", "0.3")
+    forecast_log = forecast.get("log", "")
+    dispatch = config["dispatch"] if config.has_section("dispatch") else {}
+    dispatch_workers = dispatch.get("workers", "8")
+    dispatch_max_pending = dispatch.get("max_pending", "256")
+    jobs = config["jobs"] if config.has_section("jobs") else {}
+    job_retries = jobs.get("retries", "2")
+    job_backoff = jobs.get("backoff", "1.0")
+    job_deadline = jobs.get("deadline", "120")
+    job_keep = jobs.get("keep", "100")
+    services = []
+    for section in config.sections():
+        if section.startswith("service:"):
+            rules = {}
+            for key, value in config[section].items():
+                if key.startswith("traffic_"):
+                    rules[key[len("traffic_"):]] = value
+            services.append((section[len("service:"):], rules))
     cal_period = network.get("cal_period")
+    cgroup = config["cgroup"] if config.has_section("cgroup") else {}
+    cgroup_root = cgroup.get("root", "/sys/fs/cgroup")
+    cgroup_period = cgroup.get("period", "2")
+    migration = config["migration"] if config.has_section("migration") else {}
+    migration_streams = migration.get("streams", "1")
+    migration_chunk_size = migration.get("chunk_size", "1048576")
+    migration_timeout = migration.get("timeout", "600")
+    standby = config["standby"] if config.has_section("standby") else {}
+    standby_size = standby.get("size", "0")
+    standby_priorities = standby.get("priorities", "low,medium,high")
+    agent = config["agent"] if config.has_section("agent") else {}
+    agent_period = agent.get("period", "0.1")
+    agent_python = agent.get("python", "python3")
+    agent_counters = agent.get("counters", "rx_packets")
+    agent_ring_size = agent.get("ring_size", "4096")
     priority_cpu_low = priority.get("priority_cpu_low")
     priority_mem_low = priority.get("priority_mem_low")
     priority_cpu_medium = priority.get("priority_cpu_medium")
     priority_mem_medium = priority.get("priority_mem_medium")
     priority_cpu_high = priority.get("priority_cpu_high")
     priority_mem_high = priority.get("priority_mem_high")
+    image_prepare = image.get("prepare", "sideload")
+    image_cold_pull = image.get("cold_pull", "warn")
     image = image.get("image")
 
-    return {"remote_host": remote_host, "remote_user": remote_user, "local_interface": local_interface, "remote_interface": remote_interface, \
+    return {"remote_host": remote_host, "remote_user": remote_user, "ssh_control_path": ssh_control_path, \
+            "ssh_persist": ssh_persist, "ssh_timeout": ssh_timeout, "docker_backend": docker_backend, \
+            "docker_socket": docker_socket, "docker_remote_socket": docker_remote_socket, \
+            "docker_forward_socket": docker_forward_socket, "docker_pool_size": docker_pool_size, \
+            "docker_api_version": docker_api_version, "local_interface": local_interface, "remote_interface": remote_interface, \
             "priority_cpu_low": priority_cpu_low, "priority_mem_low": priority_mem_low, "priority_cpu_medium": priority_cpu_medium, \
             "priority_mem_medium": priority_mem_medium, "priority_cpu_high": priority_cpu_high, "priority_mem_high": priority_mem_high, \
-            "image": image, "cal_period": cal_period, "throughput_low": throughput_low, "throughput_medium": throughput_medium, "throughput_high": throughput_high}
+            "image": image, "image_prepare": image_prepare, "image_cold_pull": image_cold_pull, "cal_period": cal_period, "agent_period": agent_period, "agent_python": agent_python, \
+            "agent_counters": agent_counters, "agent_ring_size": agent_ring_size, "throughput_low": throughput_low, "throughput_medium": throughput_medium, "throughput_high": throughput_high, \
+            "smoothing": smoothing, "ewma_alpha": ewma_alpha, "smoothing_window": smoothing_window, \
+            "smoothing_percentile": smoothing_percentile, "hysteresis": hysteresis, "min_dwell": min_dwell, \
+            "state_journal": state_journal, "state_snapshot": state_snapshot, "state_snapshot_every": state_snapshot_every, \
+            "state_fsync": state_fsync, "capacity_nodes": capacity_nodes, "cpu_overcommit": cpu_overcommit, "memory_overcommit": memory_overcommit, \
+            "rebalance_moves": rebalance_moves, "dashboard_events": dashboard_events, "stats_address": stats_address, "stats_port": stats_port, "replay_speed": replay_speed, "replay_duration": replay_duration, "replay_latencies": replay_latencies, \
+            "replay_patterns": replay_patterns, "record_path": record_path, "record_max_bytes": record_max_bytes, "record_keep": record_keep, \
+            "forecast_method": forecast_method, "forecast_window": forecast_window, "forecast_lead_time": forecast_lead_time, \
+            "forecast_alpha": forecast_alpha, "forecast_beta": forecast_beta, "forecast_log": forecast_log, \
+            "nodes": nodes, "services": services, "migration_streams": migration_streams, \
+            "migration_chunk_size": migration_chunk_size, "migration_timeout": migration_timeout, "standby_size": standby_size, "standby_priorities": standby_priorities, "cgroup_root": cgroup_root, "cgroup_period": cgroup_period, "dispatch_workers": dispatch_workers, "dispatch_max_pending": dispatch_max_pending, \
+            "job_retries": job_retries, "job_backoff": job_backoff, "job_deadline": job_deadline, "job_keep": job_keep}
 
 
 def get_input():
@@ -156,27 +1266,27 @@ def get_input():
                 priority = args[1]
                 node = args[2]
                 name = args[3]
-                if priority in ["low", "medium", "high"] and node in ["1", "2"] and name:
+                if priority in PRIORITIES and (node in nodes or node == "auto") and name:
                     return {"command": "deploy", "priority": priority, "node": node, "name": name}
-            print("Wrong command. Using 'deploy low/medium/high 1/2 xxx' or 'deploy --auto'")
+            print("Wrong command. Using 'deploy low/medium/high {}/auto xxx' or 'deploy --auto'".format("/".join(nodes)))
             print("See '?' or 'help'")
         
         elif user_input.startswith("migrate"):
             args = user_input.split()
-            if len(args) == 4:
+            if len(args) == 4 or (len(args) == 5 and args[4] == "--stateful"):
                 src = args[1]
                 dst = args[2]
                 name = args[3]
-                if src in ["1", "2"] and dst in ["1", "2"] and name:
-                    return {"command": "migrate", "src": src, "dst": dst, "name": name}
-            print("Wrong command. Using 'migrate 1/2 1/2 xxx'")
+                if src in nodes and (dst in nodes or dst == "auto") and name:
+                    return {"command": "migrate", "src": src, "dst": dst, "name": name, "stateful": len(args) == 5}
+            print("Wrong command. Using 'migrate {0} {0}/auto xxx [--stateful]'".format("/".join(nodes)))
             print("See '?' or 'help'")
 
         elif user_input.startswith("show"):
             content = user_input.split()[1]
-            if content in ["deployment", "priority"]:
+            if content in ["deployment", "priority", "latency", "resources", "images", "trace", "stats", "capacity"]:
                 return {"command": "show", "content": content}
-            print("Wrong command. Using 'show deployment/priority'")
+            print("Wrong command. Using 'show deployment/priority/latency/resources/images/trace/stats/capacity'")
             print("See '?' or 'help'")
             
         elif user_input.startswith("remove"):
@@ -185,16 +1295,48 @@ def get_input():
             name = args[2]
             if scope in ["node", "container"]:
                 return {"command": "remove", "scope": scope, "name": name}
-            print("Wrong command. Using 'remove node 1/2/all' or 'remove container xxx'")
+            print("Wrong command. Using 'remove node {}/all' or 'remove container xxx'".format("/".join(nodes)))
             print("See '?' or 'help'")
             
         elif user_input == "exit" or user_input == "quit":
-            message_queue.insert_message("exit")
+            global clean_exit
+            clean_exit = True
+            message_queue.close()
             sys.exit(0)
             
         elif user_input == "help" or user_input == "?":
             print_help()
             
+        elif user_input.startswith("reprioritize"):
+            args = user_input.split()
+            if len(args) >= 3 and args[1] in nodes and args[2] in PRIORITIES:
+                return {"command": "reprioritize", "node": args[1], "priority": args[2],
+                        "names": args[3:] if len(args) > 3 else None}
+            print("Wrong command. Using 'reprioritize {} low/medium/high [xxx ...]'".format("/".join(nodes)))
+            print("See '?' or 'help'")
+
+        elif user_input == "reconcile":
+            return {"command": "reconcile"}
+
+        elif user_input.startswith("rebalance"):
+            args = user_input.split()
+            if len(args) == 1 or (len(args) == 2 and args[1].isdigit()):
+                return {"command": "rebalance", "moves": int(args[1]) if len(args) == 2 else rebalance_moves}
+            print("Wrong command. Using 'rebalance [MAX_MOVES]'")
+            print("See '?' or 'help'")
+
+        elif user_input == "jobs":
+            return {"command": "jobs"}
+
+        elif user_input.startswith("wait") or user_input.startswith("cancel"):
+            args = user_input.split()
+            if args[0] == "wait" and len(args) == 1:
+                return {"command": "wait", "job": None}
+            if len(args) == 2 and args[1].isdigit():
+                return {"command": args[0], "job": int(args[1])}
+            print("Wrong command. Using 'wait [JOB]' or 'cancel JOB'")
+            print("See '?' or 'help'")
+
         elif user_input == "test":
             return {"command": "test"}
             
@@ -209,353 +1351,2602 @@ def print_welcome():
 
 def print_help():
     print("To deploy a container on one node with priority or update priority:")
-    print("     deploy PRIORITY(low/medium/high) NODE(1/2) NAME")
+    print("     deploy PRIORITY(low/medium/high) NODE(1/2/auto) NAME")
     print("     e.g., deploy low 1 container_name")
+    print("     (auto picks the node with the most room left)")
     print("To start automated deployment based on network conditions:")
     print("     deploy --auto")
     print("To migrate a container:")
-    print("     migrate SRC(1/2) DST(1/2) NAME")
+    print("     migrate SRC(1/2) DST(1/2/auto) NAME")
     print("     e.g., migrate 1 2 container_name")
+    print("To migrate a container together with its filesystem state:")
+    print("     migrate SRC(1/2) DST(1/2/auto) NAME --stateful")
     print("To list the deployment:")
     print("     show deployment")
     print("To list the priority:")
     print("     show priority")
+    print("To list CPU and memory usage of the managed containers (from cgroupfs):")
+    print("     show resources")
+    print("To list the images present on each node:")
+    print("     show images")
+    print("To summarize the recorded rates and the latest placement events of deploy --auto:")
+    print("     show trace")
+    print("To show latency histograms (ssh, docker operations, migrations, queue wait, sampler jitter):")
+    print("     show stats")
+    print("To show the round-trip latency of commands sent to remote nodes:")
+    print("     show latency")
     print("To remove all containers on a node:")
     print("     remove node NODE(1/2)")
     print("     e.g., remove node 1")
     print("To remove a container with name:")
     print("     remove container NAME")
     print("     e.g., remove container container_name")        
+    print("To change the priority of all (or the listed) containers on a node at once:")
+    print("     reprioritize NODE(1/2) PRIORITY(low/medium/high) [NAME ...]")
+    print("     e.g., reprioritize 1 high")
+    print("To make the nodes match the recorded deployment (removes strays, recreates missing containers):")
+    print("     reconcile")
+    print("To move containers off the most loaded nodes (at most MAX_MOVES migrations):")
+    print("     rebalance [MAX_MOVES]")
+    print("To list capacity and committed CPU shares and memory per node:")
+    print("     show capacity")
+    print("deploy, migrate and remove run as background jobs; the prompt comes back at once.")
+    print("To list the recent jobs with their status and latency:")
+    print("     jobs")
+    print("To wait for one job or for all of them (Ctrl+C stops waiting):")
+    print("     wait [JOB]")
+    print("To cancel a queued job (a running job does not retry its commands any more):")
+    print("     cancel JOB")
     print("To exit and clean up all containers:")
     print("     exit/quit")
+    print("     (any other way out leaves the containers running; they are recovered from the")
+    print("     state journal at the next start)")
     print("To show this information:")
     print("     help/?")    
     
 def check_existence(name):
-    ret = 0
-    if array_node1.find(name) == 1:
-        ret = 1
-    elif array_node2.find(name) == 1:
-        ret = 2
-    return ret
+    return registry.find(name)
 
 def command_deploy(priority, node, name, PRINT):
     
-    ret = check_existence(name)
+    record = registry.get(name)
+
+    if node == "auto":
+        node = record.node if record is not None else capacity_planner.reserve(name, priority)
+        if node is None:
+            if PRINT == 1:
+                print("No node has room for container [{}] with priority [{}].".format(name, priority))
+            return False
+        try:
+            return command_deploy(priority, node, name, PRINT)
+        finally:
+            capacity_planner.release(name)
     
-    if priority == "low":
-        priority_cpu = priority_cpu_low
-        priority_mem = priority_mem_low
-    elif priority == "medium":
-        priority_cpu = priority_cpu_medium
-        priority_mem = priority_mem_medium
-    elif priority == "high":
-        priority_cpu = priority_cpu_high
-        priority_mem = priority_mem_high
+    priority_cpu, priority_mem = priority_limits(priority)
         
-    if node == "1":
-        if ret == 1:
-            if array_node1.get_priority_by_name(name) == priority:
-                if PRINT == 1:
-                    print("Container [{}] already exists on node [1], and priority [{}] keep unchanged.".format(name, priority))
-            else:
-                local_command = f"docker update --cpu-shares {priority_cpu} --memory {priority_mem} {name}"
-                run_command_no_echo(local_command)
-                if PRINT == 1:
-                    print("Container [{}] already exists on node [1], but priority is changed from [{}] to [{}].".format(name, array_node1.get_priority_by_name(name), priority))
-                array_node1.update_priority_by_name(name, priority)
-        elif ret == 2:
-            print("Container [{}] already exists on node [2] with priority [{}].".format(name, array_node2.get_priority_by_name(name)))
-        elif ret == 0:
-            local_command = f"docker run -itd --network host --name {name} --cpu-shares {priority_cpu} --memory {priority_mem} {image}"
-            run_command_no_echo(local_command)
-            array_node1.insert(name, priority)
-            if PRINT == 1:
-                print("Container [{}] has been created on node [1] with priority [{}].".format(name, priority))
-    elif node == "2":
-        if ret == 2:
-            if array_node2.get_priority_by_name(name) == priority:
-                if PRINT == 1:
-                    print("Container [{}] already exists on node [2], and priority [{}] keep unchanged.".format(name, priority))
-            else:
-                remote_command = f"ssh {remote_user}@{remote_host} docker update --cpu-shares {priority_cpu} --memory {priority_mem} {name}"
-                run_command_no_echo(remote_command)
-                if PRINT == 1:
-                    print("Container [{}] already exists on node [2], but priority is changed from [{}] to [{}].".format(name, array_node2.get_priority_by_name(name), priority))
-                array_node2.update_priority_by_name(name, priority)
-        elif ret == 1:
+    if record is None:
+        if PRINT == 1 and not capacity_planner.fits(node, priority, name):
+            print("Warning: node [{}] is over capacity with container [{}] at priority [{}].".format(node, name, priority))
+        if not claim_standby(node, priority, name):
+            cold = not image_index.has(node, image)
+            if cold and not image_ready(node, PRINT):
+                return False
+            checked_call(node, "docker run", lambda: get_backend(node).run(name, priority_cpu, priority_mem, image),
+                         containers_present(node, [name]))
+            if cold:
+                image_index.refresh(node)
+        registry.insert(name, node, priority)
+        if PRINT == 1:
+            print("Container [{}] has been created on node [{}] with priority [{}].".format(name, node, priority))
+    elif record.node == node:
+        if record.priority == priority:
             if PRINT == 1:
-                print("Container [{}] already exists on node [1] with priority [{}].".format(name, array_node1.get_priority_by_name(name)))
-        elif ret == 0:
-            remote_command = f"ssh {remote_user}@{remote_host} docker run -itd --network host --name {name} --cpu-shares {priority_cpu} --memory {priority_mem} {image}" 
-            run_command_no_echo(remote_command)
-            array_node2.insert(name, priority)
+                print("Container [{}] already exists on node [{}], and priority [{}] keep unchanged.".format(name, node, priority))
+        else:
+            checked_call(node, "docker update", lambda: get_backend(node).update(name, priority_cpu, priority_mem))
             if PRINT == 1:
-                print("Container [{}] has been created on node [2] with priority [{}].".format(name, priority))
+                print("Container [{}] already exists on node [{}], but priority is changed from [{}] to [{}].".format(name, node, record.priority, priority))
+            registry.update_priority(name, priority)
+    else:
+        if PRINT == 1:
+            print("Container [{}] already exists on node [{}] with priority [{}].".format(name, record.node, record.priority))
+        return False
+    return True
 
 
 def command_remove(scope, name, PRINT):
     if scope == "node":
-        if name == "1":
-            containers = array_node1.print_name()
-            local_command = f"docker rm -f {containers}"
-            run_command_no_echo(local_command)
-            array_node1.clear()
-            if PRINT == 1:
-                print("All containers on node1 has been removed.")
-        elif name == "2":
-            containers = array_node2.print_name()
-            remote_command = f"ssh {remote_user}@{remote_host} docker rm -f {containers}"
-            run_command_no_echo(remote_command)
-            array_node2.clear()
-            if PRINT == 1:
-                print("All containers on node2 has been removed.")
-        elif name == "all":
-            containers = array_node1.print_name()
-            local_command = f"docker rm -f {containers}"
-            run_command_no_echo(local_command)
-            array_node1.clear()
-            containers = array_node2.print_name()
-            remote_command = f"ssh {remote_user}@{remote_host} docker rm -f {containers}"
-            run_command_no_echo(remote_command)
-            array_node2.clear()
-            if PRINT == 1:
-                print("All containers on all nodes has been removed.")
+        if name == "all":
+            targets = list(nodes)
+        elif name in nodes:
+            targets = [name]
         else:
             if PRINT == 1:
                 print("No such a node.")
+            return False
+        for node in targets:
+            names = registry.names(node)
+            checked_call(node, "docker rm", lambda: get_backend(node).remove(names), containers_absent(node, names))
+            registry.clear(node)
+        if PRINT == 1:
+            if name == "all":
+                print("All containers on all nodes has been removed.")
+            else:
+                print("All containers on node{} has been removed.".format(name))
     elif scope == "container":
-        found = 0
-        if array_node1.delete(name) == 1:
-            local_command = f"docker rm -f {name}"
-            run_command_no_echo(local_command)
-            found = 1
+        record = registry.get(name)
+        if record is not None:
+            checked_call(record.node, "docker rm", lambda: get_backend(record.node).remove([name]),
+                         containers_absent(record.node, [name]))
+            registry.delete(name)
             if PRINT == 1:
-                print("Container [{}] on node [1] has been removed.".format(name))
-        elif array_node2.delete(name) == 1:
-            remote_command = f"ssh {remote_user}@{remote_host} docker rm -f {name}"
-            run_command_no_echo(remote_command)
-            found = 1
-            if PRINT == 1:
-                print("Container [{}] on node [2] has been removed.".format(name))
-        if found != 1:
+                print("Container [{}] on node [{}] has been removed.".format(name, record.node))
+        else:
             if PRINT == 1:
                 print("No such a container.")
-        
+            return False
+    return True
+
+
+def command_place(priority, node, name, PRINT):
+    # bring the container to node with priority, from wherever it is at execution time;
+    # "auto" keeps an existing container where it is, like deploy
+    if node == "auto":
+        return command_deploy(priority, node, name, PRINT)
+    current = check_existence(name)
+    if current is not None and current != node and command_migrate(current, node, name, 0) is False:
+        return False
+    return command_deploy(priority, node, name, PRINT)
+
+
+SHOW_COLUMNS = {"deployment": [("CONTAINER ID", 15), ("IMAGE", 20), ("STATUS", 30), ("NAMES", 0)],
+                "priority": [("CONTAINER ID", 15), ("NAME", 25), ("CPU %", 10), ("MEM USAGE / LIMIT", 25), ("MEM %", 0)]}
+
+
+def format_row(node, row, columns):
+    line = f"{node:<6}"
+    for value, (title, width) in zip(row, columns):
+        line += f"{value:<{width}}" if width else value
+    return line
+
 
 def command_show(content):
-    if content == "deployment":
-        local_command = "docker ps"
-        remote_command = f"ssh {remote_user}@{remote_host} docker ps"
-    elif content == "priority":
-        local_command = "docker stats --no-stream"
-        remote_command = f"ssh {remote_user}@{remote_host} docker stats --no-stream"
+    if content == "resources":
+        command_show_resources()
+        return
+    if content == "images":
+        image_index.print_images()
+        return
+    if content == "trace":
+        command_show_trace()
+        return
+    if content == "stats":
+        command_show_stats()
+        return
+    if content == "capacity":
+        command_show_capacity()
+        return
+    if content == "latency":
+        for node, executor in executors.items():
+            print(f"节点{node}：", end="")
+            executor.print_latency()
+        return
+    columns = SHOW_COLUMNS[content]
+    print(format_row("NODE", [title for title, width in columns], columns))
+    # query all nodes at once and print each node's rows as soon as it answers
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+        query = (lambda node: get_backend(node).ps()) if content == "deployment" else (lambda node: get_backend(node).stats())
+        futures = {pool.submit(query, node): node for node in nodes}
+        for future in concurrent.futures.as_completed(futures):
+            node = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                print(f"{node:<6}failed: {e}")
+                continue
+            for row in rows:
+                print(format_row(node, row, columns))
 
-    print("节点1：")
-    run_command(local_command)
-    print("--------------------------------------------------------------------------------------------------------------------------------------------")
-    print("节点2：")
-    run_command(remote_command)
+
+def auto_destination(src, name, PRINT):
+    record = registry.get(name)
+    if record is None or record.node != src:
+        if PRINT == 1:
+            if record is None:
+                print("Container [{}] dose not exist.".format(name))
+            else:
+                print("Container [{}] exists on node [{}].".format(name, record.node))
+        return None
+    dst = capacity_planner.reserve(name, record.priority, exclude_node=src)
+    if dst is None and PRINT == 1:
+        print("No other node has room for container [{}].".format(name))
+    return dst
 
 
 def command_migrate(src, dst, name, PRINT):
+    if dst == "auto":
+        dst = auto_destination(src, name, PRINT)
+        if dst is None:
+            return False
+        try:
+            return command_migrate(src, dst, name, PRINT)
+        finally:
+            capacity_planner.release(name)
     if src == dst:
         if PRINT == 1:
             print("src and dst is the same node")
+        return False
+    record = registry.get(name)
+    if record is None:
+        if PRINT == 1:
+            print("Container [{}] dose not exist.".format(name))
+        return False
+    if record.node != src:
+        if PRINT == 1:
+            print("Container [{}] exists on node [{}].".format(name, record.node))
+        return False
+    if PRINT == 1 and not capacity_planner.fits(dst, record.priority, name):
+        print("Warning: node [{}] is over capacity with container [{}] at priority [{}].".format(dst, name, record.priority))
+    start = time.monotonic()
+    # make before break: the container already runs on dst when it is removed from src
+    if claim_standby(dst, record.priority, name):
+        kind = "standby"
     else:
-        ret = check_existence(name)
-        if ret == 1:
-            if src == "1" and dst == "2":
-                priority = array_node1.get_priority_by_name(name)
-                command_remove("container", name, 0)
-                command_deploy(priority, "2", name, 0)
-                if PRINT == 1:
-                    print("Container [{}] migrates from node [1] to node [2].".format(name))
-            elif src == "2":
-                if PRINT == 1:
-                    print("Container [{}] exists on node [1].".format(name))
-        elif ret == 2:
-            if src == "2" and dst == "1":
-                priority = array_node2.get_priority_by_name(name)
-                command_remove("container", name, 0)
-                command_deploy(priority, "1", name, 0)
-                if PRINT == 1:
-                    print("Container [{}] migrates from node [2] to node [1].".format(name))
-            elif src == "1":
-                if PRINT == 1:
-                    print("Container [{}] exists on node [2].".format(name))
-        else:
-            if PRINT == 1:
-                print("Container [{}] dose not exist.".format(name))
+        cold = not image_index.has(dst, image)
+        if cold and not image_ready(dst, PRINT):
+            return False
+        cpu, mem = priority_limits(record.priority)
+        checked_call(dst, "docker run", lambda: get_backend(dst).run(name, cpu, mem, image), containers_present(dst, [name]))
+        if cold:
+            image_index.refresh(dst)
+        kind = "stateless"
+    registry.insert(name, dst, record.priority)
+    checked_call(src, "docker rm", lambda: get_backend(src).remove([name]), containers_absent(src, [name]))
+    migration_latency.observe(time.monotonic() - start, kind)
+    migrations_total.inc(record.priority)
+    if PRINT == 1:
+        print("Container [{}] migrates from node [{}] to node [{}].".format(name, src, dst))
+    return True
 
 
-last_rx_packets = [0, 0]
-first_cal = 1
+def node_run(node, cmd):
+    executor = executors.get(node)
+    if executor is None:
+        return run_local_no_echo(cmd)
+    return executor.run(cmd)
 
-def calculate_rx_rate():
-    global last_rx_packets
-    global first_cal
-    
-    while True:
-        
-        local_file = f"/sys/class/net/{local_interface}/statistics/rx_packets"
-        remote_file = f"/sys/class/net/{remote_interface}/statistics/rx_packets"
-        # local_file = "/home/mzh/local_speed"
-        # remote_file = "/home/mzh/remote_speed"
-        
-        with open(local_file, "r") as f:
-            local_rx_packets = int(f.read().strip())
 
-        cmd = f"ssh {remote_user}@{remote_host} cat {remote_file}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, _ = proc.communicate()
-        remote_rx_packets = int(stdout.decode().strip())
+def node_popen(node, cmd, dedicated=False, **kwargs):
+    executor = executors.get(node)
+    if executor is None:
+        return subprocess.Popen(cmd, shell=True, **kwargs)
+    return executor.popen(cmd, dedicated, **kwargs)
 
-        local_rx_rate = local_rx_packets - last_rx_packets[0]
-        remote_rx_rate = remote_rx_packets - last_rx_packets[1]
 
-        last_rx_packets[0] = local_rx_packets
-        last_rx_packets[1] = remote_rx_packets
+COMPRESS = "$(command -v pigz || echo gzip) -1 -c"
+DECOMPRESS = "$(command -v pigz || echo gzip) -d -c"
 
-        if first_cal == 1:
-            local_rx_rate = 0
-            remote_rx_rate = 0
-            first_cal = 0
-        
-        yield (local_rx_rate, remote_rx_rate)
 
-        time.sleep(cal_period)
+def run_reassemble(argv):
+    # receiving end of a parallel transfer: frames (4-byte length + data) arrive round-robin
+    # over the fifos given after --reassemble and are written to stdout in order
+    paths = argv[argv.index("--reassemble") + 1].split(",")
+    streams = [open(path, "rb") for path in paths]
+    out = sys.stdout.buffer
+    i = 0
+    while True:
+        header = streams[i % len(streams)].read(4)
+        if len(header) < 4:
+            break
+        length = int.from_bytes(header, "big")
+        if length == 0:
+            break
+        out.write(streams[i % len(streams)].read(length))
+        i += 1
+    out.flush()
 
 
-last_event = -1
-name1 = "service_entry_A"
-name2 = "service_entry_B"
+def stream_pipe(src, source_cmd, dst, sink_cmd, streams, chunk_size, timeout, source_input=b""):
+    # source_cmd | compress on src -> relayed through this process -> decompress | sink_cmd on dst;
+    # nothing is written to disk and at most a few chunks per channel are held in memory.
+    # Each channel has its own writer thread, and with several streams its own ssh connection,
+    # so a slow channel does not hold up the others. After timeout seconds, or once the job is
+    # cancelled, every process of the transfer is killed and it fails.
+    processes = []
+    lock = threading.Lock()
+    broken = threading.Event()
+    finished = threading.Event()
+    op = getattr(dispatch_context, "op", None)
+    start = time.monotonic()
 
-def handle_event5(event):
-    global last_event
-    if last_event == 5:
-        # command_remove("container", name2, 0)
-        message_queue.insert_message("remove container " + name2 + " 0")
-        return event + f"\n           [{name2}] has been removed from node [1]."
-    else:
-        return event
-
-def deploy_strategy(local_rx_rate, remote_rx_rate, time):
-    global last_event
-    event = ""
-    if (remote_rx_rate != 0) ^ (local_rx_rate != 0):
-        if (last_event != 0) and (remote_rx_rate > 0) and (remote_rx_rate <= throughput_low):
-            # command_migrate("1", "2", name1, 0)
-            message_queue.insert_message("migrate 1 2 " + name1 + " 0")
-            # command_deploy("low", "2", name1, 0)
-            message_queue.insert_message("deploy low 2 " + name1 + " 0")
-            event = f"Event@\t{time}s: [{name1}] has been deployed on node [2] with priority [low]."
-            event = handle_event5(event)
-            last_event = 0
-        if (last_event != 1) and (remote_rx_rate > throughput_low) and (remote_rx_rate <= throughput_medium):
-            # command_migrate("1", "2", name1, 0)
-            message_queue.insert_message("migrate 1 2 " + name1 + " 0")
-            # command_deploy("medium", "2", name1, 0)
-            message_queue.insert_message("deploy medium 2 " + name1 + " 0")
-            event =  f"Event@\t{time}s: [{name1}] has been deployed on node [2] with priority [medium]."
-            event = handle_event5(event)
-            last_event = 1
-        if (last_event != 2) and (local_rx_rate > 0) and (local_rx_rate <= throughput_low):
-            # command_migrate("2", "1", name1, 0)
-            message_queue.insert_message("migrate 2 1 " + name1 + " 0")
-            # command_deploy("low", "1", name1, 0)
-            message_queue.insert_message("deploy low 1 " + name1 + " 0")
-            event = f"Event@\t{time}s: [{name1}] has been deployed on node [1] with priority [low]."
-            event = handle_event5(event)
-            last_event = 2
-        if (last_event != 3) and (local_rx_rate > throughput_low) and (local_rx_rate <= throughput_medium):
-            # command_migrate("2", "1", name1, 0)
-            message_queue.insert_message("migrate 2 1 " + name1 + " 0")
-            # command_deploy("medium", "1", name1, 0)
-            message_queue.insert_message("deploy medium 1 " + name1 + " 0")
-            event = f"Event@\t{time}s: [{name1}] has been deployed on node [1] with priority [medium]."
-            event = handle_event5(event)
-            last_event = 3
-        if (last_event != 4) and (local_rx_rate > throughput_medium) and (local_rx_rate <= throughput_high):
-            # command_migrate("2", "1", name1, 0)
-            message_queue.insert_message("migrate 2 1 " + name1 + " 0")
-            # command_deploy("high", "1", name1, 0)
-            message_queue.insert_message("deploy high 1 " + name1 + " 0")
-            event = f"Event@\t{time}s: [{name1}] has been deployed on node [1] with priority [high]."
-            event = handle_event5(event)
-            last_event = 4
-        if (last_event != 5) and (local_rx_rate > throughput_high):
-            # command_migrate("2", "1", name1, 0)
-            message_queue.insert_message("migrate 2 1 " + name1 + " 0")
-            # command_deploy("high", "1", name1, 0)
-            message_queue.insert_message("deploy high 1 " + name1 + " 0")
-            # command_deploy("high", "1", name2, 0)
-            message_queue.insert_message("deploy high 1 " + name2 + " 0")
-            event = f"Event@\t{time}s: [{name1}] and [{name2}] have been deployed on node [1] with priority [high]."
-            last_event = 5
-            
-    if event != "":
-        event_list.insert(event)
-    
+    def popen(node, cmd, dedicated=False, stdout=subprocess.DEVNULL):
+        # each process leads a session of its own, so kill() also reaches the shell's children
+        process = node_popen(node, cmd, dedicated, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+        with lock:
+            processes.append(process)
+            if broken.is_set():
+                os.killpg(process.pid, signal.SIGKILL)
+        return process
 
+    def kill():
+        with lock:
+            broken.set()
+            for process in processes:
+                if process.poll() is None:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
 
-def command_deploy_auto():
-    rx_rate_generator = calculate_rx_rate()
-    time_elapsed = 0
-    global first_cal
-    first_cal = 1
+    def watch():
+        while not finished.wait(0.2):
+            if time.monotonic() - start > timeout or (op is not None and op.stopped):
+                kill()
+                return
+
+    def feed():
+        try:
+            source.stdin.write(source_input)
+            source.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def write(channel, chunks):
+        while True:
+            data = chunks.get()
+            if data is None:
+                break
+            if broken.is_set():
+                continue
+            try:
+                channel.stdin.write(data)
+            except BrokenPipeError:
+                broken.set()
+        try:
+            channel.stdin.close()
+        except BrokenPipeError:
+            broken.set()
+
+    source = popen(src, f"{source_cmd} | {COMPRESS}", stdout=subprocess.PIPE)
+    threading.Thread(target=watch, daemon=True).start()
+    threading.Thread(target=feed, daemon=True).start()
+    transferred = 0
+    try:
+        if streams <= 1:
+            channels = [popen(dst, f"{DECOMPRESS} | {sink_cmd}")]
+        else:
+            # chunks go round-robin over the channels and are put back in order on dst by this
+            # script in --reassemble mode, reading from fifos
+            tag = os.urandom(4).hex()
+            fifos = [f"/tmp/cm-migrate-{tag}-{i}" for i in range(streams)]
+            with open(os.path.abspath(__file__), "rb") as f:
+                script = f.read()
+            loader = popen(dst, f"mkfifo {' '.join(fifos)} && {agent_python} - --reassemble {','.join(fifos)} "
+                                f"| {DECOMPRESS} | {sink_cmd}; status=$?; rm -f {' '.join(fifos)}; exit $status")
+            try:
+                loader.stdin.write(script)
+                loader.stdin.close()
+            except BrokenPipeError:
+                # the receiving end is already gone (e.g. no agent_python on dst)
+                kill()
+                return False, 0, time.monotonic() - start
+            channels = [popen(dst, f"while [ ! -p {fifo} ]; do sleep 0.05; done; cat > {fifo}", True)
+                        for fifo in fifos]
+        queues = [queue.Queue(maxsize=4) for channel in channels]
+        writers = [threading.Thread(target=write, args=(channel, chunks), daemon=True)
+                   for channel, chunks in zip(channels, queues)]
+        for writer in writers:
+            writer.start()
+        i = 0
+        while not broken.is_set():
+            chunk = source.stdout.read(chunk_size)
+            if not chunk:
+                break
+            queues[i % len(queues)].put(chunk if streams <= 1 else len(chunk).to_bytes(4, "big") + chunk)
+            transferred += len(chunk)
+            i += 1
+        if streams > 1:
+            queues[i % len(queues)].put((0).to_bytes(4, "big"))
+        for chunks in queues:
+            chunks.put(None)
+        for writer in writers:
+            writer.join()
+        if broken.is_set():
+            # the receiving side went away: stop the sender instead of letting it block on a full pipe
+            kill()
+        ok = not broken.is_set()
+        for process in processes:
+            ok = process.wait() == 0 and ok
+        return ok, transferred, time.monotonic() - start
+    except BaseException:
+        kill()
+        raise
+    finally:
+        finished.set()
+        for process in processes:
+            process.wait()
+
+
+def stream_image(src, dst, image_name, streams, chunk_size, timeout):
+    return stream_pipe(src, f"docker save {image_name}", dst, "docker load", streams, chunk_size, timeout)
+
+
+def command_migrate_stateful(src, dst, name, PRINT):
+    # Moves the container's writable layer, i.e. what `docker diff` lists, onto a fresh container
+    # from the same image on dst: added and changed paths are streamed as a tar made inside the
+    # container, deleted ones are removed once it runs. The source keeps running until the copy
+    # on dst has started; on any failure the copy on dst is removed and the source stays.
+    if dst == "auto":
+        dst = auto_destination(src, name, PRINT)
+        if dst is None:
+            return False
+        try:
+            return command_migrate_stateful(src, dst, name, PRINT)
+        finally:
+            capacity_planner.release(name)
+    record = registry.get(name)
+    if src == dst or record is None or record.node != src:
+        return command_migrate(src, dst, name, PRINT)
+    if not image_ready(dst, PRINT):
+        return False
+    start = time.monotonic()
+    result = node_run(src, f"docker inspect --format '{{{{.Config.Image}}}}' {name} && docker diff {name}")
+    if not result.ok():
+        if PRINT == 1:
+            print("Changes of container [{}] could not be listed: {}".format(name, result.stderr.decode().strip()))
+        return False
+    lines = result.stdout.decode().splitlines()
+    base = lines[0]
+    changed = [line[2:].lstrip("/") for line in lines[1:] if line[:2] in ["A ", "C "]]
+    deleted = [line[2:] for line in lines[1:] if line[:2] == "D "]
+    cpu, mem = priority_limits(record.priority)
+    ok, transferred, elapsed = False, 0, 0.0
+    try:
+        checked_call(dst, "docker create",
+                     lambda: node_run(dst, f"docker create -it {container_options(name, cpu, mem)} {base}"),
+                     containers_present(dst, [name]))
+        ok = True
+        if len(changed) > 0:
+            ok, transferred, elapsed = stream_pipe(
+                src, f"docker exec -i {name} tar -cf - --no-recursion --verbatim-files-from -C / -T -",
+                dst, f"docker cp -a - {name}:/", migration_streams, migration_chunk_size, migration_timeout,
+                ("\n".join(changed) + "\n").encode())
+        if ok:
+            command = f"docker start {name}"
+            if len(deleted) > 0:
+                command += f" && docker exec {name} rm -rf -- " + " ".join(shlex.quote(path) for path in deleted)
+            ok = node_run(dst, command).ok()
+    finally:
+        if not ok:
+            node_run(dst, f"docker rm -f {name}")
+            if PRINT == 1:
+                print("Transfer of container [{}] to node [{}] failed, it keeps running on node [{}].".format(name, dst, src))
+    if not ok:
+        return False
+    registry.insert(name, dst, record.priority)
+    checked_call(src, "docker rm", lambda: get_backend(src).remove([name]), containers_absent(src, [name]))
+    migration_latency.observe(time.monotonic() - start, "stateful")
+    migrations_total.inc(record.priority)
+    if PRINT == 1:
+        rate = transferred / elapsed / 1024 / 1024 if elapsed > 0 else 0
+        print("Container [{}] migrates from node [{}] to node [{}] with its filesystem state.".format(name, src, dst))
+        print(f"Transferred {len(changed)} changed paths, {format_size(transferred)} (compressed) in {elapsed:.2f} s, "
+              f"{rate:.1f} MiB/s over {migration_streams} stream(s); {len(deleted)} deleted.")
+    return True
+
+
+class ImageIndex:
+    # Per node: image reference -> (repo digest, image id), taken from `docker images --digests`;
+    # every image is also listed under repo@digest, so digest-pinned references resolve. The
+    # configured image is
+    # brought to every node before placements need it (pulled, or pulled once and side-loaded),
+    # and placements onto a node without it are warned about or refused instead of pulling inline.
+    def __init__(self, mode, cold_pull):
+        self.mode = mode
+        self.cold_pull = cold_pull
+        self.images = {node: {} for node in nodes}
+        self.loaded = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(ref):
+        if "@" in ref or ":" in ref.rsplit("/", 1)[-1]:
+            return ref
+        return ref + ":latest"
+
+    def refresh(self, node):
+        result = node_run(node, "docker images --digests --no-trunc "
+                                "--format '{{.Repository}}:{{.Tag}}\t{{.Digest}}\t{{.ID}}'")
+        if not result.ok():
+            return False
+        images = {}
+        for line in result.stdout.decode().splitlines():
+            fields = line.split("\t")
+            if len(fields) != 3:
+                continue
+            ref, digest, image_id = fields
+            # images loaded with docker load have no repo digest
+            digest = None if digest == "<none>" else digest
+            if not ref.endswith(":<none>"):
+                images[ref] = (digest, image_id)
+            if digest is not None:
+                images[f"{ref.rpartition(':')[0]}@{digest}"] = (digest, image_id)
+        with self.lock:
+            self.images[node] = images
+            self.loaded.add(node)
+        return True
+
+    def assume(self, ref):
+        # simulated nodes (replay) have every image and nothing to query
+        with self.lock:
+            for node in nodes:
+                self.images[node] = {self.normalize(ref): (None, "simulated")}
+                self.loaded.add(node)
+
+    def refresh_all(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+            return dict(zip(nodes, pool.map(self.refresh, nodes)))
+
+    def lookup(self, node, ref):
+        if node not in self.loaded:
+            self.refresh(node)
+        with self.lock:
+            return self.images.get(node, {}).get(self.normalize(ref))
+
+    def has(self, node, ref):
+        return self.lookup(node, ref) is not None
+
+    def pull(self, node, ref, PRINT):
+        start = time.monotonic()
+        ok = node_run(node, f"docker pull -q {ref}").ok()
+        if PRINT == 1:
+            state = "pulled" if ok else "could not be pulled"
+            print(f"Image [{ref}] {state} on node [{node}] in {time.monotonic() - start:.2f} s.")
+        return ok
+
+    def side_load(self, src, dst, ref, PRINT):
+        ok, transferred, elapsed = stream_image(src, dst, ref, migration_streams, migration_chunk_size, migration_timeout)
+        if PRINT == 1:
+            state = "side-loaded" if ok else "could not be side-loaded"
+            print(f"Image [{ref}] {state} from node [{src}] to node [{dst}]: "
+                  f"{format_size(transferred)} (compressed) in {elapsed:.2f} s.")
+        return ok
+
+    def prepare(self, ref, PRINT):
+        self.refresh_all()
+        if self.mode == "off":
+            return
+        missing = [node for node in nodes if not self.has(node, ref)]
+        if len(missing) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                if self.mode == "pull":
+                    list(pool.map(lambda node: self.pull(node, ref, PRINT), missing))
+                else:
+                    # pull once (on this host if it needs the image), then copy it to the other nodes
+                    sources = [node for node in nodes if node not in missing]
+                    if len(sources) == 0:
+                        first = next((node for node in missing if node not in executors), missing[0])
+                        if self.pull(first, ref, PRINT):
+                            sources.append(first)
+                            missing.remove(first)
+                    if len(sources) > 0:
+                        list(pool.map(lambda node: self.side_load(sources[0], node, ref, PRINT), missing))
+            self.refresh_all()
+        # content-addressed image ids tell versions apart also for side-loaded images, which
+        # have no repo digest
+        ids = {entry[1] for entry in (self.lookup(node, ref) for node in nodes) if entry is not None}
+        if PRINT == 1:
+            for node in nodes:
+                if not self.has(node, ref):
+                    print(f"Warning: image [{ref}] is still missing on node [{node}].")
+            if len(ids) > 1:
+                print(f"Warning: nodes hold different versions of image [{ref}], see 'show images'.")
+
+    def print_images(self):
+        self.refresh_all()
+        print(f"{'NODE':<6}{'IMAGE':<40}{'ID':<21}DIGEST")
+        with self.lock:
+            for node in nodes:
+                for ref, (digest, image_id) in sorted(self.images[node].items()):
+                    if "@" not in ref:
+                        print(f"{node:<6}{ref:<40}{image_id[:19]:<21}{digest or '-'}")
+
+
+def image_ready(node, PRINT):
+    # False only when the placement must not go ahead; a warned cold pull still returns True
+    if image_index.cold_pull == "allow" or image_index.has(node, image):
+        return True
+    if image_index.cold_pull == "refuse":
+        if PRINT == 1:
+            print(f"Image [{image}] is not on node [{node}], placement refused (it would be pulled first).")
+        return False
+    if PRINT == 1:
+        print(f"Warning: image [{image}] is not on node [{node}], it will be pulled before the container starts.")
+    return True
+
+
+def reload_image_config(PRINT=1, wait=True):
+    # The image is re-prepared on every node when it is changed in config.ini while running
+    # (between commands, on every deploy --auto tick and before every batch request); without
+    # wait the nodes are prepared in the background. Returns the new image, or None.
+    global image, config_mtime
+    mtime = os.path.getmtime("config.ini")
+    if mtime == config_mtime:
+        return None
+    config_mtime = mtime
+    configured = read_config()["image"]
+    if configured == image:
+        return None
+    if PRINT == 1:
+        print(f"Image changed from [{image}] to [{configured}], preparing the nodes.")
+    image = configured
+
+    def prepare():
+        image_index.prepare(configured, PRINT)
+        standby_pool.flush()
+
+    if wait:
+        prepare()
+    else:
+        threading.Thread(target=prepare, name="image-prepare", daemon=True).start()
+    return configured
+
+
+STANDBY_PREFIX = "cm-standby-"
+
+
+class StandbyPool:
+    # Pre-created, paused containers per node and priority. Deploy and migrate claim one
+    # (rename + unpause) instead of a cold docker run; the pool is refilled in the background.
+    def __init__(self, size, priorities):
+        self.size = size
+        self.priorities = priorities
+        self.ready = {node: {priority: collections.deque() for priority in priorities} for node in nodes}
+        self.filling = {node: {priority: 0 for priority in priorities} for node in nodes}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(nodes)), thread_name_prefix="standby")
+
+    def claim(self, node, priority):
+        with self.lock:
+            ready = self.ready.get(node, {}).get(priority)
+            if not ready:
+                return None
+            return ready.popleft()
+
+    def create(self, node, priority):
+        name = f"{STANDBY_PREFIX}{priority}-{os.urandom(4).hex()}"
+        cpu, mem = priority_limits(priority)
+        result = get_backend(node).run_paused(name, cpu, mem, image)
+        with self.lock:
+            self.filling[node][priority] -= 1
+            if result.ok():
+                self.ready[node][priority].append(name)
+        if not result.ok():
+            get_backend(node).remove([name])
+
+    def refill(self, node=None, priority=None):
+        if self.size <= 0:
+            return
+        for n in ([node] if node is not None else list(nodes)):
+            if image_index.cold_pull != "allow" and not image_index.has(n, image):
+                continue
+            for p in ([priority] if priority is not None else self.priorities):
+                if p not in self.priorities:
+                    continue
+                with self.lock:
+                    missing = self.size - len(self.ready[n][p]) - self.filling[n][p]
+                    self.filling[n][p] += max(0, missing)
+                for i in range(missing):
+                    self.pool.submit(self.create, n, p)
+
+    def flush(self):
+        # drop the standbys (e.g. built from a previous image) and build new ones
+        with self.lock:
+            dropped = {node: [name for ready in self.ready[node].values() for name in ready] for node in self.ready}
+            for node in self.ready:
+                for ready in self.ready[node].values():
+                    ready.clear()
+        for node, names in dropped.items():
+            get_backend(node).remove(names)
+        self.refill()
+
+    def drain(self):
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            for node in self.ready:
+                names = [name for ready in self.ready[node].values() for name in ready]
+                get_backend(node).remove(names)
+                for ready in self.ready[node].values():
+                    ready.clear()
+
+
+def claim_standby(node, priority, name):
+    standby = standby_pool.claim(node, priority)
+    if standby is None:
+        return False
+    standby_pool.refill(node, priority)
+    if get_backend(node).claim(standby, name).ok():
+        return True
+    # the claim may have failed after the rename (e.g. on unpause): remove the container under
+    # either name, so the cold start that follows does not collide with it
+    get_backend(node).remove([standby, name])
+    return False
+
+
+def priority_limits(priority):
+    if priority == "low":
+        return priority_cpu_low, priority_mem_low
+    elif priority == "medium":
+        return priority_cpu_medium, priority_mem_medium
+    return priority_cpu_high, priority_mem_high
+
+
+def priority_of_cpu_shares(cpu_shares):
+    for priority in ["low", "medium", "high"]:
+        if int(priority_limits(priority)[0]) == cpu_shares:
+            return priority
+    return None
+
+
+# CPU shares (nproc * 1024) and MemTotal (kB) of a node
+DISCOVER_CAPACITY = "echo $(( $(nproc) * 1024 )) $(awk '/MemTotal/ {print $2}' /proc/meminfo)"
+# a rebalancing move has to lower the peak node load by at least this much
+REBALANCE_MIN_GAIN = 0.05
+
+
+class CapacityPlanner:
+    # Chooses nodes from per-node capacity ([capacity] or discovered from nproc and
+    # /proc/meminfo) and what the registry already commits there. CPU shares may be committed
+    # up to cpu_overcommit times the capacity, memory limits up to memory_overcommit times.
+    # Among the nodes with room the one left least loaded wins; concurrent choices reserve
+    # their share until the container is in the registry.
+    def __init__(self, configured, cpu_overcommit, memory_overcommit, discover):
+        self.configured = configured
+        self.cpu_overcommit = cpu_overcommit
+        self.memory_overcommit = memory_overcommit
+        self.discover = discover
+        self.capacities = {}
+        self.reserved = {}
+        self.lock = threading.RLock()
+
+    def measure(self, node):
+        # None when the node could not be measured
+        cpu, memory = self.configured.get(node, (None, None))
+        if (cpu is None or memory is None) and self.discover:
+            result = node_run(node, DISCOVER_CAPACITY)
+            fields = result.stdout.split() if result.ok() else []
+            if len(fields) != 2:
+                return None
+            cpu = cpu or int(fields[0])
+            memory = memory or int(fields[1]) * 1024
+        return (cpu or float("inf"), memory or float("inf"))
+
+    def discover_all(self):
+        # measures every node once, in parallel; returns the nodes that could not be measured
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+            self.capacities.update(zip(nodes, pool.map(self.measure, nodes)))
+        return [node for node in nodes if self.capacities[node] is None]
+
+    def capacity(self, node):
+        # a failed measurement is kept as well: the node is not probed again on every call
+        if node not in self.capacities:
+            self.capacities[node] = self.measure(node)
+        return self.capacities[node]
+
+    @staticmethod
+    def demand(priority):
+        cpu, mem = priority_limits(priority)
+        return int(cpu), parse_size(mem)
+
+    def committed(self, node, exclude=None):
+        cpu = mem = 0
+        with self.lock:
+            entries = registry.entries(node) + [(name, priority) for name, (n, priority) in self.reserved.items() if n == node]
+        for name, priority in entries:
+            if name != exclude:
+                c, m = self.demand(priority)
+                cpu += c
+                mem += m
+        return cpu, mem
+
+    def load(self, node, cpu, mem):
+        # fraction of what may be committed on the node; above 1 it does not fit, and a node of
+        # unknown capacity has no room
+        capacity = self.capacity(node)
+        if capacity is None:
+            return float("inf")
+        capacity_cpu, capacity_mem = capacity
+        return max(cpu / (capacity_cpu * self.cpu_overcommit), mem / (capacity_mem * self.memory_overcommit))
+
+    def fits(self, node, priority, name=None):
+        cpu, mem = self.committed(node, name)
+        c, m = self.demand(priority)
+        return self.load(node, cpu + c, mem + m) <= 1
+
+    def reserve(self, name, priority, exclude_node=None):
+        c, m = self.demand(priority)
+        with self.lock:
+            best = None
+            for node in nodes:
+                if node == exclude_node:
+                    continue
+                cpu, mem = self.committed(node, name)
+                load = self.load(node, cpu + c, mem + m)
+                if load <= 1 and (best is None or load < best[0]):
+                    best = (load, node)
+            if best is None:
+                return None
+            self.reserved[name] = (best[1], priority)
+            return best[1]
+
+    def release(self, name):
+        with self.lock:
+            self.reserved.pop(name, None)
+
+    def rebalance(self, max_moves, pinned=(), pending=None):
+        # up to max_moves (name, src, dst), each taking a container off the most loaded node
+        # to where it lowers the peak of the two the most; nodes of unknown capacity are left out.
+        # pending: name -> (node, priority), or None for a removal, submitted but maybe not applied yet
+        known = [node for node in nodes if self.capacity(node) is not None]
+        if len(known) < 2:
+            return []
+        used = {node: list(self.committed(node)) for node in known}
+        placement = {name: (node, priority) for name, node, priority in registry.snapshot()}
+        for name, target in (pending or {}).items():
+            for sign, entry in [(-1, placement.pop(name, None)), (1, target)]:
+                if entry is not None and entry[0] in used:
+                    c, m = self.demand(entry[1])
+                    used[entry[0]][0] += sign * c
+                    used[entry[0]][1] += sign * m
+            if target is not None:
+                placement[name] = target
+        placement = {name: entry for name, entry in placement.items() if name not in pinned and entry[0] in used}
+        moves = []
+        while len(moves) < max_moves:
+            src = max(known, key=lambda node: self.load(node, *used[node]))
+            peak = self.load(src, *used[src])
+            best = None
+            for name, (node, priority) in placement.items():
+                if node != src:
+                    continue
+                c, m = self.demand(priority)
+                for dst in known:
+                    if dst == src:
+                        continue
+                    after = max(self.load(src, used[src][0] - c, used[src][1] - m),
+                                self.load(dst, used[dst][0] + c, used[dst][1] + m))
+                    if after <= peak - REBALANCE_MIN_GAIN and self.load(dst, used[dst][0] + c, used[dst][1] + m) <= 1 \
+                            and (best is None or after < best[0]):
+                        best = (after, name, dst, c, m)
+            if best is None:
+                break
+            after, name, dst, c, m = best
+            used[src][0] -= c
+            used[src][1] -= m
+            used[dst][0] += c
+            used[dst][1] += m
+            placement[name] = (dst, placement[name][1])
+            moves.append((name, src, dst))
+        return moves
+
+
+def command_rebalance(max_moves, PRINT):
+    moves = capacity_planner.rebalance(max_moves)
+    if len(moves) == 0 and PRINT == 1:
+        print("The nodes are balanced, nothing to move.")
+    for name, src, dst in moves:
+        job_table.submit(Operation("migrate", name, src=src, dst=dst))
+
+
+def command_show_capacity():
+    print(f"{'NODE':<6}{'CPU SHARES':>24}{'MEMORY':>24}{'LOAD':>8}")
+    for node in nodes:
+        cpu, mem = capacity_planner.committed(node)
+        if capacity_planner.capacity(node) is None:
+            print(f"{node:<6}{f'{cpu} / ?':>24}{format_size(mem) + ' / ?':>24}{'?':>8}")
+            continue
+        capacity_cpu, capacity_mem = capacity_planner.capacity(node)
+        print(f"{node:<6}{f'{cpu} / {capacity_cpu:g}':>24}"
+              f"{f'{format_size(mem)} / ' + (format_size(capacity_mem) if capacity_mem != float('inf') else 'inf'):>24}"
+              f"{capacity_planner.load(node, cpu, mem) * 100:>7.0f}%")
+
+
+class Reconciler:
+    # Holds the desired placement (name -> (node, priority)) and converges the nodes to it:
+    # one bulk listing per node, then per node one batched remove, one update per priority
+    # and one batch of parallel creates. Nodes are handled concurrently.
+    def __init__(self):
+        self.desired = {}
+        self.lock = threading.Lock()
+
+    def set(self, name, node, priority):
+        with self.lock:
+            self.desired[name] = (node, priority)
+
+    def unset(self, name):
+        with self.lock:
+            self.desired.pop(name, None)
+
+    def load_from_registry(self):
+        with self.lock:
+            self.desired = {name: (node, priority) for name, node, priority in registry.snapshot()}
+
+    def actual_state(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(backends)) as pool:
+            futures = {node: pool.submit(get_backend(node).list) for node in backends}
+            return {node: future.result() for node, future in futures.items()}
+
+    def diff(self, actual):
+        with self.lock:
+            desired = dict(self.desired)
+        plan = {}
+        for node, containers in actual.items():
+            if containers is None:
+                continue
+            remove = []
+            update = {}
+            create = {}
+            for name, (cpu_shares, running, container_id) in containers.items():
+                if name.startswith(STANDBY_PREFIX):
+                    continue
+                want = desired.get(name)
+                if want is None or want[0] != node or not running:
+                    remove.append(name)
+                elif priority_of_cpu_shares(cpu_shares) != want[1]:
+                    update.setdefault(want[1], []).append(name)
+            for name, (want_node, priority) in desired.items():
+                if want_node == node and (name not in containers or not containers[name][1]):
+                    create.setdefault(priority, []).append(name)
+            plan[node] = {"remove": remove, "update": update, "create": create, "errors": []}
+        return plan
+
+    @staticmethod
+    def check(steps, what, result):
+        if result is not None and not result.ok():
+            steps["errors"].append(f"{what}: {result.stderr.decode(errors='replace').strip()}")
+
+    def apply_removes(self, node, steps):
+        self.check(steps, "docker rm", get_backend(node).remove(steps["remove"]))
+
+    def apply_changes(self, node, steps):
+        backend = get_backend(node)
+        for priority, names in steps["update"].items():
+            cpu, mem = priority_limits(priority)
+            self.check(steps, "docker update", backend.update_many(names, cpu, mem))
+        specs = []
+        for priority, names in steps["create"].items():
+            cpu, mem = priority_limits(priority)
+            specs += [(name, cpu, mem) for name in names]
+        self.check(steps, "docker run", backend.run_many(specs, image))
+
+    def apply(self, plan):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(plan))) as pool:
+            # removals first, so a container moving between nodes never runs twice
+            list(pool.map(lambda node: self.apply_removes(node, plan[node]), plan))
+            list(pool.map(lambda node: self.apply_changes(node, plan[node]), plan))
+        with self.lock:
+            desired = dict(self.desired)
+        for node, steps in plan.items():
+            entries = [(name, priority) for name, (want_node, priority) in desired.items() if want_node == node]
+            if len(steps["errors"]) > 0:
+                entries = self.verify(node, steps, entries)
+            registry.replace_node(node, entries)
+
+    @staticmethod
+    def verify(node, steps, entries):
+        # some step failed: list the node again and record what it really runs, so a failed
+        # create is not registered and a failed update keeps the priority the container has
+        containers = get_backend(node).list()
+        if containers is None:
+            created = set(name for names in steps["create"].values() for name in names)
+            return [(name, priority) for name, priority in entries if name not in created]
+        updated = set(name for names in steps["update"].values() for name in names)
+        verified = []
+        for name, priority in entries:
+            if name in containers and containers[name][1]:
+                if name in updated:
+                    priority = priority_of_cpu_shares(containers[name][0]) or priority
+                verified.append((name, priority))
+        return verified
+
+    def reconcile(self):
+        plan = self.diff(self.actual_state())
+        self.apply(plan)
+        return plan
+
+
+def command_reconcile(PRINT):
+    reconciler.load_from_registry()
+    start = time.monotonic()
+    plan = reconciler.reconcile()
+    if PRINT == 1:
+        for node in backends:
+            if node not in plan:
+                print(f"Node [{node}] could not be listed, skipped.")
+                continue
+            steps = plan[node]
+            updated = sum(len(names) for names in steps["update"].values())
+            created = sum(len(names) for names in steps["create"].values())
+            print(f"Node [{node}]: {len(steps['remove'])} removed, {updated} updated, {created} created.")
+            for error in steps["errors"]:
+                print(f"Node [{node}]: {error}")
+        print(f"Converged in {(time.monotonic() - start) * 1000:.0f} ms.")
+
+
+CGROUP_FILES = ["cpu.stat", "cpu.weight", "memory.current", "memory.max"]
+# container cgroups under the systemd and the cgroupfs cgroup drivers
+CGROUP_PATTERNS = ["system.slice/docker-*.scope", "docker/*"]
+
+
+def cgroup_container_id(path):
+    base = os.path.basename(path.rstrip("/"))
+    if base.startswith("docker-") and base.endswith(".scope"):
+        return base[len("docker-"):-len(".scope")]
+    return base
+
+
+def parse_cgroup_values(files):
+    usage_usec = 0
+    for line in files.get("cpu.stat", "").splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == "usage_usec":
+            usage_usec = int(fields[1])
+    memory_max = files.get("memory.max", "max").strip()
+    return {"usage_usec": usage_usec,
+            "cpu_weight": int(files.get("cpu.weight", "100").strip() or 100),
+            "memory_current": int(files.get("memory.current", "0").strip() or 0),
+            "memory_max": None if memory_max in ["max", ""] else int(memory_max)}
+
+
+def read_cgroup_tree(root):
+    # one pass over the container cgroups on this host: id -> raw values
+    with open("/proc/uptime") as f:
+        ts = float(f.read().split()[0])
+    containers = {}
+    for pattern in CGROUP_PATTERNS:
+        for path in glob.glob(os.path.join(root, pattern)):
+            files = {}
+            for name in CGROUP_FILES:
+                try:
+                    with open(os.path.join(path, name)) as f:
+                        files[name] = f.read()
+                except OSError:
+                    pass
+            if "cpu.stat" in files:
+                containers[cgroup_container_id(path)] = parse_cgroup_values(files)
+    return ts, containers
+
+
+def cgroup_tree_command(root):
+    # the same pass as read_cgroup_tree as a single shell command for remote nodes
+    dirs = " ".join(os.path.join(root, pattern) for pattern in CGROUP_PATTERNS)
+    cats = "; ".join(f'echo "== {name}"; cat "$d/{name}" 2>/dev/null' for name in CGROUP_FILES)
+    return f'cat /proc/uptime; for d in {dirs}; do [ -f "$d/cpu.stat" ] || continue; echo "@@ $d"; {cats}; done'
+
+
+def parse_cgroup_tree_output(output):
+    lines = output.splitlines()
+    ts = float(lines[0].split()[0])
+    containers = {}
+    path = None
+    files = {}
+    current = None
+
+    def flush():
+        if path is not None:
+            containers[cgroup_container_id(path)] = parse_cgroup_values(files)
+
+    for line in lines[1:]:
+        if line.startswith("@@ "):
+            flush()
+            path = line[3:]
+            files = {}
+            current = None
+        elif line.startswith("== "):
+            current = line[3:]
+            files[current] = ""
+        elif current is not None:
+            files[current] += line + "\n"
+    flush()
+    return ts, containers
+
+
+class CgroupCollector:
+    # Bulk per-container CPU and memory usage read straight from cgroup v2 files, one pass
+    # per node. CPU usage is a rate from the usage_usec deltas between two passes.
+    def __init__(self, root):
+        self.root = root
+        self.names = {node: {} for node in nodes}
+        self.unmanaged = {node: set() for node in nodes}
+        self.previous = {node: {} for node in nodes}
+        self.latest = {node: {} for node in nodes}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def read(self, node):
+        executor = executors.get(node)
+        if executor is None:
+            return read_cgroup_tree(self.root)
+        result = executor.run(cgroup_tree_command(self.root))
+        return parse_cgroup_tree_output(result.stdout.decode())
+
+    def resolve_names(self, node, ids):
+        # the node is listed again only for cgroups not seen before; ids the listing did not
+        # name are other containers and are remembered as such (container ids are never reused)
+        names = self.names[node]
+        unmanaged = self.unmanaged[node]
+        unmanaged &= set(ids)
+        if any(container_id not in names and container_id not in unmanaged for container_id in ids):
+            containers = get_backend(node).list()
+            if containers is None:
+                return names
+            names.clear()
+            for name, (cpu_shares, running, container_id) in containers.items():
+                names[container_id] = name
+            unmanaged.update(container_id for container_id in ids if container_id not in names)
+        return names
+
+    def collect(self, node):
+        ts, raw = self.read(node)
+        names = self.resolve_names(node, raw.keys())
+        previous = self.previous[node]
+        stats = {}
+        for container_id, values in raw.items():
+            name = names.get(container_id)
+            if name is None:
+                continue
+            cpu_percent = None
+            if container_id in previous:
+                last_ts, last_usage = previous[container_id]
+                if ts > last_ts:
+                    cpu_percent = (values["usage_usec"] - last_usage) / 1e6 / (ts - last_ts) * 100
+            memory_percent = None
+            if values["memory_max"]:
+                memory_percent = values["memory_current"] / values["memory_max"] * 100
+            stats[name] = {"cpu_percent": cpu_percent, "cpu_weight": values["cpu_weight"],
+                           "memory_current": values["memory_current"], "memory_max": values["memory_max"],
+                           "memory_percent": memory_percent}
+        self.previous[node] = {container_id: (ts, values["usage_usec"]) for container_id, values in raw.items()}
+        with self.lock:
+            self.latest[node] = stats
+        return stats
+
+    def collect_all(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+            futures = {node: pool.submit(self.collect, node) for node in nodes}
+            results = {}
+            for node, future in futures.items():
+                try:
+                    results[node] = future.result()
+                except Exception:
+                    results[node] = None
+            return results
+
+    def get(self, node, name):
+        with self.lock:
+            return self.latest.get(node, {}).get(name)
+
+    def run(self, period):
+        while not self.stop_event.is_set():
+            self.collect_all()
+            self.stop_event.wait(period)
+
+    def start(self, period):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(period,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def cpu_shares_to_weight(cpu_shares):
+    # the conversion runc applies to --cpu-shares on cgroup v2
+    cpu_shares = int(cpu_shares)
+    if cpu_shares == 0:
+        return 100
+    return 1 + ((cpu_shares - 2) * 9999) // 262142
+
+
+def cgroup_write_command(root, entries):
+    parts = []
+    for name, container_id, weight, memory in entries:
+        dirs = f"{root}/system.slice/docker-{container_id}.scope {root}/docker/{container_id}"
+        parts.append(f'd=""; for c in {dirs}; do [ -d "$c" ] && d="$c"; done; '
+                     f'if [ -n "$d" ] && echo {weight} > "$d/cpu.weight" && echo {memory} > "$d/memory.max"; '
+                     f'then echo "ok {name}"; else echo "fail {name}"; fi')
+    return "(" + "; ".join(parts) + ") 2>/dev/null"
+
+
+def write_cgroup_limits(node, entries):
+    # entries [(name, id, cpu.weight, memory.max)] -> name -> written
+    executor = executors.get(node)
+    if executor is not None:
+        result = executor.run(cgroup_write_command(cgroup_collector.root, entries))
+        written = {name: False for name, container_id, weight, memory in entries}
+        for line in result.stdout.decode().splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] in written:
+                written[fields[1]] = fields[0] == "ok"
+        return written
+    written = {}
+    for name, container_id, weight, memory in entries:
+        written[name] = False
+        for pattern in [f"system.slice/docker-{container_id}.scope", f"docker/{container_id}"]:
+            path = os.path.join(cgroup_collector.root, pattern)
+            if os.path.isdir(path):
+                try:
+                    with open(os.path.join(path, "cpu.weight"), "w") as f:
+                        f.write(str(weight))
+                    with open(os.path.join(path, "memory.max"), "w") as f:
+                        f.write(str(memory))
+                    written[name] = True
+                except OSError:
+                    pass
+                break
+    return written
+
+
+def reprioritize(node, priority, names=None):
+    # Set many containers of one node to a priority in one pass over cgroupfs; containers
+    # whose cgroup could not be written get one batched docker update instead.
+    if names is None:
+        names = registry.names(node)
+    names = [name for name in names if registry.find(name) == node]
+    if len(names) == 0:
+        return {}
+    cpu, mem = priority_limits(priority)
+    containers = get_backend(node).list() or {}
+    entries = [(name, containers[name][2], cpu_shares_to_weight(cpu), parse_size(mem))
+               for name in names if name in containers]
+    written = write_cgroup_limits(node, entries) if len(entries) > 0 else {}
+    results = {name: written.get(name, False) for name in names}
+    failed = [name for name in names if not results[name]]
+    if len(failed) > 0:
+        result = get_backend(node).update_many(failed, cpu, mem)
+        if result is not None and result.ok():
+            for name in failed:
+                results[name] = True
+    with registry.lock:
+        for name, ok in results.items():
+            if ok:
+                registry.update_priority(name, priority)
+    return results
+
+
+def command_reprioritize(node, priority, names, PRINT):
+    start = time.monotonic()
+    results = reprioritize(node, priority, names)
+    if PRINT == 1:
+        if len(results) == 0:
+            print("No container to change on node [{}].".format(node))
+        for name, ok in results.items():
+            if ok:
+                print("Container [{}] on node [{}] is now priority [{}].".format(name, node, priority))
+            else:
+                print("Container [{}] on node [{}] could not be changed.".format(name, node))
+        print(f"{sum(results.values())}/{len(results)} containers changed in {(time.monotonic() - start) * 1000:.0f} ms.")
+
+
+def command_show_resources():
+    # two passes give every container a CPU rate
+    if not any(cgroup_collector.previous.values()):
+        cgroup_collector.collect_all()
+        time.sleep(cgroup_period)
+    results = cgroup_collector.collect_all()
+    print(f"{'NODE':<6}{'NAME':<25}{'CPU %':<10}{'CPU WEIGHT':<12}{'MEM USAGE / LIMIT':<25}MEM %")
+    for node in nodes:
+        if results[node] is None:
+            print(f"{node:<6}failed to read cgroups")
+            continue
+        for name, stats in sorted(results[node].items()):
+            cpu = f"{stats['cpu_percent']:.2f}" if stats["cpu_percent"] is not None else "-"
+            limit = format_size(stats["memory_max"]) if stats["memory_max"] else "max"
+            mem = f"{stats['memory_percent']:.2f}" if stats["memory_percent"] is not None else "-"
+            print(f"{node:<6}{name:<25}{cpu:<10}{stats['cpu_weight']:<12}"
+                  f"{format_size(stats['memory_current']) + ' / ' + limit:<25}{mem}")
+
+
+class SampleRing:
+    # Fixed-capacity ring of timestamped counter rows, preallocated in flat arrays so that
+    # appending a sample does not allocate.
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.timestamps = array.array("d", bytes(8 * capacity))
+        self.values = array.array("q", bytes(8 * capacity * width))
+        self.head = 0
+        self.count = 0
+
+    def append(self, ts, values):
+        slot = self.head
+        self.timestamps[slot] = ts
+        base = slot * self.width
+        for i in range(self.width):
+            self.values[base + i] = values[i]
+        self.head = (slot + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def slot(self, age):
+        # age 0 is the newest sample
+        return (self.head - 1 - age) % self.capacity
+
+    def rate(self, column, window):
+        if self.count < 2:
+            return 0
+        newest = self.slot(0)
+        newest_ts = self.timestamps[newest]
+        oldest = self.slot(self.count - 1)
+        for age in range(1, self.count):
+            slot = self.slot(age)
+            if newest_ts - self.timestamps[slot] >= window:
+                oldest = slot
+                break
+        dt = newest_ts - self.timestamps[oldest]
+        if dt <= 0:
+            return 0
+        return (self.values[newest * self.width + column] - self.values[oldest * self.width + column]) / dt
+
+    def rates(self, column, window):
+        rates = []
+        if self.count < 2:
+            return rates
+        newer = self.slot(0)
+        newest_ts = self.timestamps[newer]
+        for age in range(1, self.count):
+            older = self.slot(age)
+            if newest_ts - self.timestamps[older] > window:
+                break
+            dt = self.timestamps[newer] - self.timestamps[older]
+            if dt > 0:
+                rates.append((self.values[newer * self.width + column] - self.values[older * self.width + column]) / dt)
+            newer = older
+        return rates
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        slot = self.slot(0)
+        return self.timestamps[slot], self.values[slot * self.width:(slot + 1) * self.width].tolist()
+
+
+class CounterSampler:
+    # Keeps the sysfs counter files open and re-reads them with pread at a fixed period.
+    def __init__(self, interfaces, counters):
+        self.columns = [(interface, counter) for interface in interfaces for counter in counters]
+        self.fds = [os.open(f"/sys/class/net/{interface}/statistics/{counter}", os.O_RDONLY)
+                    for interface, counter in self.columns]
+        self.row = [0] * len(self.fds)
+
+    def sample(self):
+        ts = time.monotonic()
+        row = self.row
+        for i, fd in enumerate(self.fds):
+            row[i] = int(os.pread(fd, 32, 0))
+        return ts, row
+
+    def run(self, period, push, stop_event=None):
+        next_time = time.monotonic()
+        while stop_event is None or not stop_event.is_set():
+            ts, row = self.sample()
+            push(ts, row)
+            # sleep to an absolute deadline so the sampling period does not drift
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def parse_agent_args(argv):
+    args = {"interface": "eth0", "period": "0.1", "counters": "rx_packets"}
+    for i in range(len(argv) - 1):
+        if argv[i].startswith("--") and argv[i][2:] in args:
+            args[argv[i][2:]] = argv[i + 1]
+    return args["interface"].split(","), args["counters"].split(","), float(args["period"])
+
+
+def run_agent(argv):
+    interfaces, counters, period = parse_agent_args(argv)
+    sampler = CounterSampler(interfaces, counters)
+    out = sys.stdout
+    out.write("# " + " ".join(f"{interface}:{counter}" for interface, counter in sampler.columns) + "\n")
+    out.flush()
+
+    def emit(ts, values):
+        out.write(f"{ts:.6f} " + " ".join(str(v) for v in values) + "\n")
+        out.flush()
+
+    try:
+        sampler.run(period, emit)
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        sampler.close()
+
+
+class MetricsStream:
+    # Holds the most recent timestamped counter samples of one node in a SampleRing.
+    # Rates are computed from the sampler's own monotonic timestamps.
+    def __init__(self, node, interfaces, counters, period, capacity):
+        self.node = node
+        self.interfaces = interfaces
+        self.counters = counters
+        self.columns = [(interface, counter) for interface in interfaces for counter in counters]
+        self.period = period
+        self.ring = SampleRing(capacity, len(self.columns))
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_ts = None
+
+    def push(self, ts, values):
+        if self.last_ts is not None:
+            sampler_jitter.observe(abs(ts - self.last_ts - self.period), self.node)
+        self.last_ts = ts
+        with self.lock:
+            self.ring.append(ts, values)
+
+    def rate(self, counter, window, interface=None):
+        if interface is None:
+            interface = self.interfaces[0]
+        column = self.columns.index((interface, counter))
+        with self.lock:
+            return self.ring.rate(column, window)
+
+    def rates(self, counter, window, interface=None):
+        if interface is None:
+            interface = self.interfaces[0]
+        column = self.columns.index((interface, counter))
+        with self.lock:
+            return self.ring.rates(column, window)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.last_ts = None
+        with self.lock:
+            self.ring.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class LocalMetricsStream(MetricsStream):
+    def run(self):
+        sampler = CounterSampler(self.interfaces, self.counters)
+        try:
+            sampler.run(self.period, self.push, self.stop_event)
+        finally:
+            sampler.close()
+
+
+class RemoteMetricsStream(MetricsStream):
+    # Starts the agent mode of this script on the remote node over the ssh master connection
+    # (the script itself is piped to the remote python), then reads its sample stream.
+    def __init__(self, node, interfaces, counters, period, capacity, executor, python):
+        super().__init__(node, interfaces, counters, period, capacity)
+        self.executor = executor
+        self.python = python
+        self.proc = None
+
+    def run(self):
+        with open(os.path.abspath(__file__), "rb") as f:
+            script = f.read()
+        width = len(self.columns)
+        row = [0] * width
+        while not self.stop_event.is_set():
+            cmd = f"{self.python} - --agent --interface {','.join(self.interfaces)} " \
+                  f"--counters {','.join(self.counters)} --period {self.period}"
+            self.proc = self.executor.popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                self.proc.stdin.write(script)
+                self.proc.stdin.close()
+                for line in self.proc.stdout:
+                    if self.stop_event.is_set():
+                        break
+                    if line.startswith(b"#"):
+                        continue
+                    fields = line.split()
+                    for i in range(width):
+                        row[i] = int(fields[i + 1])
+                    self.push(float(fields[0]), row)
+            except (OSError, ValueError, IndexError):
+                pass
+            self.proc.kill()
+            self.proc.wait()
+            # agent exited or the connection dropped: restart it
+            self.stop_event.wait(1)
+
+    def stop(self):
+        super().stop()
+        if self.proc is not None:
+            self.proc.kill()
+
+
+class RateSmoother:
+    # none: rate over the last period; ewma: exponentially weighted average of the period rates;
+    # percentile: percentile of the per-sample rates in the ring over the last window seconds
+    def __init__(self, stream, mode, alpha, window, percentile):
+        self.stream = stream
+        self.mode = mode
+        self.alpha = alpha
+        self.window = window
+        self.percentile = percentile
+        self.value = None
+        self.raw = 0
+
+    def reset(self):
+        self.value = None
+
+    def rate(self, period):
+        raw = self.stream.rate("rx_packets", period)
+        self.raw = raw
+        if raw == 0 and self.mode != "none":
+            # traffic that stopped reads 0 at once instead of decaying over many periods, so the
+            # strategy's single-active-node check sees the node go idle right away; the EWMA
+            # starts over from the first sample once traffic comes back
+            self.value = None
+            return 0
+        if self.mode == "percentile":
+            rates = sorted(self.stream.rates("rx_packets", self.window))
+            if len(rates) == 0:
+                return 0
+            return rates[min(len(rates) - 1, int(len(rates) * self.percentile / 100))]
+        if self.mode == "ewma":
+            if self.value is None:
+                self.value = raw
+            else:
+                self.value = self.alpha * raw + (1 - self.alpha) * self.value
+            return self.value
+        return raw
+
+
+def calculate_rx_rate():
+    for node in nodes:
+        metrics[node].start()
+        smoothers[node].reset()
+    try:
+        while True:
+            time.sleep(cal_period)
+            yield {node: int(round(smoothers[node].rate(cal_period))) for node in nodes}
+    finally:
+        for node in nodes:
+            metrics[node].stop()
+
+
+class Forecaster:
+    # Rate forecast for one node over the last `window` ticks, extrapolated `lead` ticks ahead:
+    # linear fits a least-squares line to the window, holt runs Holt's double exponential
+    # smoothing (level + trend). Every forecast is later compared with the rate that arrives.
+    def __init__(self, node, method, window, lead, alpha, beta):
+        self.node = node
+        self.method = method
+        window = max(1, window)
+        self.window = window
+        self.lead = lead
+        self.alpha = alpha
+        self.beta = beta
+        self.xs = array.array("d", range(window))
+        self.sum_x = sum(self.xs)
+        self.denominator = window * sum(x * x for x in self.xs) - self.sum_x * self.sum_x
+        self.values = array.array("d", bytes(8 * window))
+        self.reset()
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.tick = 0
+        self.level = None
+        self.trend = 0
+        self.pending = collections.deque()
+        self.abs_error = 0
+        self.errors = 0
+
+    def update(self, rate, now):
+        self.tick += 1
+        while len(self.pending) > 0 and self.pending[0][0] <= self.tick:
+            due, predicted = self.pending.popleft()
+            if due == self.tick:
+                self.abs_error += abs(predicted - rate)
+                self.errors += 1
+                if forecast_log is not None:
+                    forecast_log.write(f"{now}\t{self.node}\t{predicted:.0f}\t{rate}\t{predicted - rate:.0f}\n")
+        self.values[self.head] = rate
+        self.head = (self.head + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+        if self.level is None:
+            self.level = rate
+        else:
+            level = self.alpha * rate + (1 - self.alpha) * (self.level + self.trend)
+            self.trend = self.beta * (level - self.level) + (1 - self.beta) * self.trend
+            self.level = level
+        predicted = self.predict()
+        if predicted is not None:
+            self.pending.append((self.tick + self.lead, predicted))
+        return predicted
+
+    def predict(self):
+        if self.method == "holt":
+            return None if self.count < 2 else max(0, self.level + self.lead * self.trend)
+        if self.count < self.window:
+            return None
+        if self.denominator == 0:
+            # a one-tick window has no trend: the forecast is the last rate
+            return self.values[(self.head - 1) % self.window]
+        # oldest sample first, so x = 0 .. window - 1 and the forecast is at window - 1 + lead
+        ys = self.values[self.head:] + self.values[:self.head]
+        sum_y = sum(ys)
+        slope = (self.window * sum(map(float.__mul__, self.xs, ys)) - self.sum_x * sum_y) / self.denominator
+        intercept = (sum_y - slope * self.sum_x) / self.window
+        return max(0, intercept + slope * (self.window - 1 + self.lead))
+
+    def mean_error(self):
+        return self.abs_error / self.errors if self.errors > 0 else None
+
+
+def forecast_rates(rates, now):
+    # the policy sees the forecast where it is above the measured rate, so rising traffic moves
+    # containers `lead_time` early; falling traffic still follows the measured rate
+    if forecast_method == "off":
+        return rates, {}
+    planned = dict(rates)
+    predictions = {}
+    for node, rate in rates.items():
+        predicted = forecasters[node].update(rate, now)
+        if predicted is None:
+            continue
+        predictions[node] = int(round(predicted))
+        if rate != 0:
+            planned[node] = max(rate, predictions[node])
+    return planned, predictions
+
+
+TRACE_MAGIC = b"CMTRACE1"
+# time, kind, node, container name, then three values whose meaning depends on the kind
+TRACE_RECORD = struct.Struct("<dB7s24sddq")
+TRACE_RATE = 0       # node: raw rx pps, forecast pps (nan without forecast)
+TRACE_CONTAINER = 1  # node, name: CPU %, -, memory bytes
+TRACE_PLACE = 2      # node, name: priority index
+TRACE_REMOVE = 3     # node, name
+
+
+class TraceRecorder:
+    # Append-only file of fixed-size binary records, starting with a header record holding
+    # TRACE_MAGIC. The records of a tick are packed into a reused buffer and written with one
+    # call; once the file would exceed max_bytes it is rotated to path.1 .. path.KEEP.
+    def __init__(self, path, max_bytes, keep):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.buffer = bytearray(TRACE_RECORD.size * 64)
+        self.used = 0
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        if not self.path or self.file is not None:
+            return
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(TRACE_MAGIC.ljust(TRACE_RECORD.size, b"\0"))
+            self.size = TRACE_RECORD.size
+
+    def add(self, kind, node, name="", a=0.0, b=float("nan"), c=-1):
+        if self.file is None:
+            return
+        with self.lock:
+            if self.used + TRACE_RECORD.size > len(self.buffer):
+                self.buffer.extend(bytes(len(self.buffer)))
+            TRACE_RECORD.pack_into(self.buffer, self.used, time.time(), kind, node.encode(), name.encode(), a, b, c)
+            self.used += TRACE_RECORD.size
+
+    def flush(self):
+        if self.file is None:
+            return
+        with self.lock:
+            if self.used == 0:
+                return
+            if self.size + self.used > self.max_bytes:
+                self.rotate()
+            self.file.write(memoryview(self.buffer)[:self.used])
+            self.file.flush()
+            self.size += self.used
+            self.used = 0
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.keep > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TraceReader:
+    # Memory-mapped trace file; a record is only decoded when it is accessed, and time ranges
+    # are found by binary search since records are appended in time order.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < TRACE_RECORD.size:
+            self.file.close()
+            raise ValueError(f"{path} is not a trace file")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        self.count = size // TRACE_RECORD.size - 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        ts, kind, node, name, a, b, c = TRACE_RECORD.unpack_from(self.map, (index + 1) * TRACE_RECORD.size)
+        return ts, kind, node.rstrip(b"\0").decode(), name.rstrip(b"\0").decode(), a, b, c
+
+    def timestamp(self, index):
+        return TRACE_RECORD.unpack_from(self.map, (index + 1) * TRACE_RECORD.size)[0]
+
+    def index(self, ts):
+        # first record at or after ts
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def between(self, start, end):
+        return self[self.index(start):self.index(end)]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def format_trace_record(record):
+    ts, kind, node, name, a, b, c = record
+    when = datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S.%f")[:-3]
+    if kind == TRACE_RATE:
+        return f"{when}  node [{node}] RX rate {a:.0f} pps" + ("" if b != b else f", forecast {b:.0f} pps")
+    if kind == TRACE_CONTAINER:
+        return f"{when}  [{name}] on node [{node}]: CPU {a:.1f}%, memory {format_size(c)}"
+    if kind == TRACE_PLACE:
+        return f"{when}  [{name}] deployed on node [{node}] with priority [{PRIORITIES[int(a)]}]"
+    return f"{when}  [{name}] removed from node [{node}]"
+
+
+def command_show_trace():
+    trace_recorder.flush()
+    try:
+        reader = TraceReader(trace_path)
+    except (OSError, ValueError) as e:
+        print(f"No trace recorded: {e}")
+        return
+    try:
+        if len(reader) == 0:
+            print(f"{trace_path}: no records.")
+            return
+        span = reader.timestamp(len(reader) - 1) - reader.timestamp(0)
+        print(f"{trace_path}: {len(reader)} records over {span:.1f} s.")
+        events = [record for record in reader[-1000:] if record[1] in [TRACE_PLACE, TRACE_REMOVE]]
+        for record in events[-10:]:
+            print(format_trace_record(record))
+    finally:
+        reader.close()
+
+
+class PlacementPolicy:
+    # Policy table compiled from the [service:NAME] sections. For every traffic source node,
+    # services with the same thresholds share one sorted bound array, so a tick costs one
+    # bisect per distinct threshold set plus a table lookup per service.
+    def __init__(self, services):
+        self.names = [name for name, rules in services]
+        self.groups = {}
+        keys = {}
+        for index, (name, rules) in enumerate(services):
+            for source, tiers in rules.items():
+                bounds = tuple(bound for bound, action in tiers)
+                key = (source, bounds)
+                if key not in keys:
+                    keys[key] = (array.array("d", bounds), [])
+                    self.groups.setdefault(source, []).append(keys[key])
+                keys[key][1].append((index, [action for bound, action in tiers]))
+        self.reset()
+
+    def reset(self):
+        self.placement = [None] * len(self.names)
+        self.tier = [None] * len(self.names)
+        self.changed_at = [0] * len(self.names)
+
+    @staticmethod
+    def parse_tiers(text):
+        # "5000:1:low, 50000:1:medium, inf:keep": upper bound of the rate, then the
+        # placement (node:priority), "off" (not deployed) or "keep" (leave as is)
+        tiers = []
+        for entry in text.split(","):
+            fields = entry.strip().split(":")
+            bound = float(fields[0])
+            if fields[1] in ["off", "keep"]:
+                tiers.append((bound, fields[1]))
+            else:
+                tiers.append((bound, (fields[1], fields[2])))
+        tiers.sort(key=lambda tier: tier[0])
+        if tiers[-1][0] != float("inf"):
+            tiers.append((float("inf"), "keep"))
+        return tiers
+
+    def evaluate(self, rates, now):
+        # decide only while exactly one node receives traffic
+        active = [node for node, rate in rates.items() if rate != 0]
+        if len(active) != 1:
+            return []
+        source = active[0]
+        rate = rates[source]
+        decisions = []
+        for bounds, members in self.groups.get(source, []):
+            tier = bisect.bisect_left(bounds, rate)
+            for index, actions in members:
+                target = tier
+                current = self.tier[index]
+                if current is not None and current[0] == source and current[1] != tier:
+                    # hysteresis: only leave the current tier once the rate is clearly outside of it
+                    lower = bounds[current[1] - 1] if current[1] > 0 else 0
+                    upper = bounds[current[1]]
+                    if lower * (1 - hysteresis) < rate <= upper * (1 + hysteresis):
+                        target = current[1]
+                action = actions[target]
+                if action == "keep" or (source, target) == current:
+                    continue
+                if current is not None and now - self.changed_at[index] < min_dwell:
+                    continue
+                self.tier[index] = (source, target)
+                placement = None if action == "off" else action
+                if placement != self.placement[index]:
+                    decisions.append((index, self.placement[index], placement))
+                    self.placement[index] = placement
+                    self.changed_at[index] = now
+        decisions.sort()
+        return [(self.names[index], old, new) for index, old, new in decisions]
+
+    def targets(self, rates):
+        # where each service belongs at these rates, ignoring hysteresis and dwell time;
+        # services whose tier says "keep" are left out
+        active = [node for node, rate in rates.items() if rate != 0]
+        if len(active) != 1:
+            return {}
+        source = active[0]
+        targets = {}
+        for bounds, members in self.groups.get(source, []):
+            tier = bisect.bisect_left(bounds, rates[source])
+            for index, actions in members:
+                if actions[tier] != "keep":
+                    targets[self.names[index]] = None if actions[tier] == "off" else actions[tier]
+        return targets
+
+
+def default_policy_rules():
+    low = f"{throughput_low}"
+    medium = f"{throughput_medium}"
+    high = f"{throughput_high}"
+    return [("service_entry_A", {"1": f"{low}:1:low, {medium}:1:medium, {high}:1:high, inf:1:high",
+                                 "2": f"{low}:2:low, {medium}:2:medium, inf:keep"}),
+            ("service_entry_B", {"1": f"{high}:off, inf:1:high",
+                                 "2": f"{medium}:off, inf:keep"})]
+
+
+def deploy_strategy(rates, time):
+    # returns the decisions taken as (name, old, new, future of the submitted operation)
+    submitted = []
+    for name, old, new in placement_policy.evaluate(rates, time):
+        if new is None:
+            future = message_queue.submit(Operation("remove", name))
+            trace_recorder.add(TRACE_REMOVE, old[0], name)
+            event_list.insert(f"Event@\t{time}s: [{name}] has been removed from node [{old[0]}].")
+        else:
+            node, priority = new
+            future = message_queue.submit(Operation("place", name, priority=priority, node=node))
+            trace_recorder.add(TRACE_PLACE, node, name, PRIORITIES.index(priority))
+            event_list.insert(f"Event@\t{time}s: [{name}] has been deployed on node [{node}] with priority [{priority}].")
+        submitted.append((name, old, new, future))
+    return submitted
+
+
+def command_deploy_auto():
+    global forecast_log
+    rx_rate_generator = calculate_rx_rate()
+    cgroup_collector.start(cgroup_period)
+    for forecaster in forecasters.values():
+        forecaster.reset()
+    if forecast_method != "off" and forecast_log_path:
+        forecast_log = open(forecast_log_path, "a", buffering=1)
+        forecast_log.write("# time\tnode\tpredicted\tactual\terror\n")
+    trace_recorder.open()
+    dashboard.start()
+    time_elapsed = 0
+    ticks = 0
     
     while True:
         try:
-            local_rx_rate, remote_rx_rate = next(rx_rate_generator)
-            time_elapsed += cal_period
-            os.system('clear')
-            print("Automatically adjust the deployment of containers based on network throughput.")
-            print("Type 'Ctrl + C' to quit.")
-            print(f"\nTime elapsed: {time_elapsed} s")
-            print(f"Node [1] RX rate: {local_rx_rate} pps")
-            print(f"Node [2] RX rate: {remote_rx_rate} pps")
-            event_list.print_all()
-            deploy_strategy(local_rx_rate, remote_rx_rate, time_elapsed)
+            rx_rates = next(rx_rate_generator)
+            ticks += 1
+            time_elapsed = round(ticks * cal_period, 3)
+            changed = reload_image_config(0, False)
+            if changed is not None:
+                event_list.insert(f"Event@\t{time_elapsed}s: image changed to [{changed}], preparing the nodes.")
+            frame = ["Automatically adjust the deployment of containers based on network throughput.",
+                     "Type 'Ctrl + C' to quit.", "", f"Time elapsed: {time_elapsed} s"]
+            planned_rates, predictions = forecast_rates(rx_rates, time_elapsed)
+            for node, rx_rate in rx_rates.items():
+                # the raw rate is recorded, so a replay can try other smoothing settings on it
+                trace_recorder.add(TRACE_RATE, node, "", int(round(smoothers[node].raw)), predictions.get(node, float("nan")))
+                if node in predictions:
+                    error = forecasters[node].mean_error()
+                    frame.append(f"Node [{node}] RX rate: {rx_rate} pps, forecast in {forecast_lead_time} s: "
+                                 f"{predictions[node]} pps" + (f" (mean error {error:.0f} pps)" if error is not None else ""))
+                else:
+                    frame.append(f"Node [{node}] RX rate: {rx_rate} pps")
+            frame.append(f"Queue depth: {message_queue.depth()}, superseded: {message_queue.superseded}, "
+                         f"actuation lag: {message_queue.last_lag * 1000:.0f} ms (max {message_queue.max_lag * 1000:.0f} ms)")
+            for name in placement_policy.names:
+                node = registry.find(name)
+                stats = cgroup_collector.get(node, name) if node is not None else None
+                if stats is not None and stats["cpu_percent"] is not None:
+                    trace_recorder.add(TRACE_CONTAINER, node, name, stats["cpu_percent"], c=stats["memory_current"])
+                    frame.append(f"[{name}] on node [{node}]: CPU {stats['cpu_percent']:.1f}%, "
+                                 f"memory {format_size(stats['memory_current'])}")
+            frame += event_list.strings
+            dashboard.update(frame)
+            submitted = deploy_strategy(planned_rates, time_elapsed)
+            if len(submitted) > 0 and rebalance_moves > 0:
+                # traffic shifted: make room around the policy's services with a few bounded moves,
+                # planned against the placements just submitted rather than the registry alone
+                pending = {name: new for name, old, new, future in submitted}
+                for name, src, dst in capacity_planner.rebalance(rebalance_moves, placement_policy.names, pending):
+                    message_queue.submit(Operation("migrate", name, src=src, dst=dst))
+                    event_list.insert(f"Event@\t{time_elapsed}s: [{name}] is rebalanced from node [{src}] to node [{dst}].")
+            trace_recorder.flush()
         except KeyboardInterrupt:
-            message_queue.insert_message("remove container {name1} 1")
-            message_queue.insert_message("remove container {name2} 1")
-            last_event = -1
+            dashboard.stop()
+            for name in placement_policy.names:
+                message_queue.submit(Operation("remove", name, PRINT=1))
+            placement_policy.reset()
             event_list.clear()
+            rx_rate_generator.close()
+            cgroup_collector.stop()
+            if forecast_log is not None:
+                forecast_log.close()
+                forecast_log = None
+            trace_recorder.close()
             break;
             
 
 
+def parse_replay_args(argv):
+    args = {"source": argv[argv.index("--replay") + 1] if argv.index("--replay") + 1 < len(argv) else "synthetic",
+            "speed": None, "json": "--json" in argv}
+    if "--speed" in argv:
+        args["speed"] = float(argv[argv.index("--speed") + 1])
+    return args
+
+
+def synthetic_trace(patterns, duration):
+    # patterns: node -> [(time, rate), ...]; the rate is interpolated linearly between the points
+    ticks = []
+    for tick in range(int(duration / cal_period) + 1):
+        now = tick * cal_period
+        rates = {}
+        for node in nodes:
+            points = patterns.get(node, [(0, 0)])
+            i = bisect.bisect_right([t for t, rate in points], now)
+            if i == 0 or i == len(points):
+                rates[node] = int(points[max(0, i - 1)][1])
+            else:
+                (t0, r0), (t1, r1) = points[i - 1], points[i]
+                rates[node] = int(r0 + (r1 - r0) * (now - t0) / (t1 - t0))
+        ticks.append(rates)
+    return ticks
+
+
+def recorded_trace(path):
+    # one tick per round of TRACE_RATE records: a tick ends when a node shows up again
+    ticks = []
+    reader = TraceReader(path)
+    try:
+        for ts, kind, node, name, rate, forecast, memory in reader:
+            if kind != TRACE_RATE or node not in nodes:
+                continue
+            if len(ticks) == 0 or node in ticks[-1]:
+                ticks.append({})
+            ticks[-1][node] = int(rate)
+    finally:
+        reader.close()
+    return [{node: rates.get(node, 0) for node in nodes} for rates in ticks]
+
+
+class TraceStream:
+    # Stands in for a node's MetricsStream in a replay: each tick's rate is added to a running
+    # rx counter sampled at the simulated time, so RateSmoother works on it as on live samples.
+    def __init__(self, capacity):
+        self.ring = SampleRing(capacity, 1)
+        self.counter = 0
+        self.ring.append(-cal_period, [0])
+
+    def push(self, now, rate):
+        self.counter += int(rate * cal_period)
+        self.ring.append(now, [self.counter])
+
+    def rate(self, counter, window, interface=None):
+        return self.ring.rate(0, window)
+
+    def rates(self, counter, window, interface=None):
+        return self.ring.rates(0, window)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_replay(args):
+    # Feeds a trace through the configured smoothing, forecast_rates and deploy_strategy against
+    # SimulatedBackends, with simulated time running `speed` times faster than the wall clock.
+    speed = replay_speed
+    if args["source"] == "synthetic":
+        ticks = synthetic_trace(replay_patterns, replay_duration)
+    else:
+        ticks = recorded_trace(args["source"])
+    streams = {node: TraceStream(agent_ring_size) for node in nodes}
+    replay_smoothers = {node: RateSmoother(streams[node], config["smoothing"], float(config["ewma_alpha"]),
+                                           float(config["smoothing_window"]), float(config["smoothing_percentile"]))
+                        for node in nodes}
+    decision_latencies = []
+    lags = []
+    lags_lock = threading.Lock()
+    migrations = 0
+    operations = 0
+    wrong = {name: 0 for name in placement_policy.names}
+
+    def completed(future, submitted_at):
+        with lags_lock:
+            lags.append((time.monotonic() - submitted_at) * speed)
+
+    start = time.monotonic()
+    for tick, rates in enumerate(ticks):
+        now = round(tick * cal_period, 3)
+        delay = start + now / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        decided_at = time.perf_counter()
+        submitted_at = time.monotonic()
+        for node in nodes:
+            streams[node].push(now, rates[node])
+        smoothed = {node: int(round(replay_smoothers[node].rate(cal_period))) for node in nodes}
+        planned_rates, predictions = forecast_rates(smoothed, now)
+        submitted = deploy_strategy(planned_rates, now)
+        decision_latencies.append(time.perf_counter() - decided_at)
+        for name, old, new, future in submitted:
+            operations += 1
+            if old is not None and new is not None and old[0] != new[0]:
+                migrations += 1
+            future.add_done_callback(lambda future, submitted_at=submitted_at: completed(future, submitted_at))
+        # a tick counts as wrong while the deployed placement differs from the instantaneous target
+        for name, target in placement_policy.targets(rates).items():
+            record = registry.get(name)
+            actual = None if record is None else (record.node, record.priority)
+            if actual != target:
+                wrong[name] += 1
+    message_queue.join()
+    elapsed = time.monotonic() - start
+    simulated = len(ticks) * cal_period
+
+    report = {"ticks": len(ticks), "simulated_s": simulated, "wall_s": round(elapsed, 3),
+              "decision_latency_us": {"mean": round(sum(decision_latencies) / max(1, len(decision_latencies)) * 1e6, 1),
+                                      "p99": round(percentile(decision_latencies, 99) * 1e6, 1),
+                                      "max": round(max(decision_latencies, default=0) * 1e6, 1)},
+              "actuation_lag_s": {"mean": round(sum(lags) / max(1, len(lags)), 3),
+                                  "p99": round(percentile(lags, 99), 3), "max": round(max(lags, default=0), 3)},
+              "operations": operations, "superseded": message_queue.superseded, "migrations": migrations,
+              "wrong_tier_s": {name: round(count * cal_period, 3) for name, count in wrong.items()}}
+    if args["json"]:
+        print(json.dumps(report))
+        return
+    print(f"Replayed {len(ticks)} ticks ({simulated:.1f} s simulated) in {elapsed:.2f} s (x{speed:g}).")
+    latency = report["decision_latency_us"]
+    print(f"Decision latency: mean {latency['mean']} us, p99 {latency['p99']} us, max {latency['max']} us")
+    lag = report["actuation_lag_s"]
+    print(f"Actuation lag: mean {lag['mean']} s, p99 {lag['p99']} s, max {lag['max']} s (simulated)")
+    print(f"Operations: {operations} submitted, {message_queue.superseded} superseded, {migrations} migrations")
+    for name, seconds in report["wrong_tier_s"].items():
+        share = seconds / simulated * 100 if simulated > 0 else 0
+        print(f"[{name}] in the wrong tier for {seconds} s ({share:.1f}%)")
+
+
+class Operation:
+    __slots__ = ("kind", "name", "priority", "node", "src", "dst", "scope", "PRINT", "future", "enqueued_at",
+                 "started_at", "finished_at", "retries", "stopped", "job", "superseded_by", "output")
+
+    def __init__(self, kind, name, priority=None, node=None, src=None, dst=None, scope="container", PRINT=0):
+        self.kind = kind
+        self.name = name
+        self.priority = priority
+        self.node = node
+        self.src = src
+        self.dst = dst
+        self.scope = scope
+        self.PRINT = PRINT
+        self.future = None
+        self.enqueued_at = 0.0
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self.retries = 0
+        self.stopped = False
+        self.job = None
+        self.superseded_by = None
+        self.output = None
+
+    def sets_state(self):
+        # place and container removal fully determine where the container ends up,
+        # so they supersede whatever is still queued for the same container
+        return self.kind == "place" or (self.kind == "remove" and self.scope == "container")
+
+    def key(self):
+        # operations on the same container keep their order; node-wide removals are barriers
+        if self.kind == "remove" and self.scope == "node":
+            return None
+        return self.name
+
+    def __repr__(self):
+        if self.kind == "deploy":
+            return f"deploy {self.priority} {self.node} {self.name}"
+        if self.kind == "place":
+            return f"place {self.priority} {self.node} {self.name}"
+        if self.kind == "migrate":
+            return f"migrate {self.src} {self.dst} {self.name}"
+        if self.kind == "migrate_stateful":
+            return f"migrate {self.src} {self.dst} {self.name} --stateful"
+        return f"remove {self.scope} {self.name}"
+
+    def status(self):
+        future = self.future
+        if future.cancelled():
+            if self.superseded_by is None:
+                return "cancelled"
+            if self.superseded_by.job is None:
+                return f"superseded by [{self.superseded_by}]"
+            return f"superseded by job {self.superseded_by.job}"
+        if not future.done():
+            if self.started_at == 0.0:
+                return "queued"
+            return f"running for {time.monotonic() - self.started_at:.3f} s" + \
+                (f", {self.retries} retried command(s)" if self.retries > 0 else "")
+        timing = f"{self.finished_at - self.started_at:.3f} s (queued {self.started_at - self.enqueued_at:.3f} s" \
+                 f"{f', {self.retries} retried command(s)' if self.retries > 0 else ''})"
+        # what the command printed (kept aside for jobs) says what happened or why not
+        detail = " ".join(line.strip() for line in "".join(self.output or []).splitlines() if line.strip())
+        if future.exception() is not None:
+            return f"failed after {timing}: {future.exception()}"
+        if future.result() is False:
+            return f"failed after {timing}: {detail or 'not applied'}"
+        return f"done in {timing}" + (f": {detail}" if detail else "")
+
+
+def execute_operation(op):
+    if op.kind == "deploy":
+        return command_deploy(op.priority, op.node, op.name, op.PRINT)
+    elif op.kind == "migrate":
+        return command_migrate(op.src, op.dst, op.name, op.PRINT)
+    elif op.kind == "migrate_stateful":
+        return command_migrate_stateful(op.src, op.dst, op.name, op.PRINT)
+    elif op.kind == "place":
+        return command_place(op.priority, op.node, op.name, op.PRINT)
+    elif op.kind == "remove":
+        return command_remove(op.scope, op.name, op.PRINT)
+    raise ValueError(f"unknown operation {op.kind}")
+
+
 class MessageQueue:
-    def __init__(self):
-        self.queue = queue.Queue()
+    # Runs operations on a bounded worker pool. Operations on the same container run in
+    # submission order, different containers run concurrently; submit() blocks once
+    # max_pending operations are outstanding.
+    def __init__(self, workers, max_pending):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = {}
+        self.barrier = False
+        self.closed = False
+        self.superseded = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
 
-    def insert_message(self, message):
-        self.queue.put(message)
+    def submit(self, op):
+        op.future = concurrent.futures.Future()
+        op.enqueued_at = time.monotonic()
+        self.slots.acquire()
+        key = op.key()
+        with self.changed:
+            while self.barrier:
+                self.changed.wait()
+            if key is None:
+                # wait for everything already queued, then hold new operations until done
+                self.barrier = True
+                while len(self.pending) > 0:
+                    self.changed.wait()
+            if key in self.pending:
+                ops = self.pending[key]
+                if op.sets_state():
+                    # ops still queued (not yet started) for this container are superseded
+                    while len(ops) > 0:
+                        superseded = ops.pop()
+                        superseded.superseded_by = op
+                        superseded.future.cancel()
+                        self.superseded += 1
+                        self.slots.release()
+                ops.append(op)
+            else:
+                self.pending[key] = collections.deque([op])
+                self.pool.submit(self.drain, key)
+        return op.future
 
-    def process_messages(self):
+    def drain(self, key):
         while True:
-            message = self.queue.get()
-            args = message.split()
-            if args[0] == "deploy":
-                if len(args) == 5:
-                    command_deploy(args[1], args[2], args[3], int(args[4]))
-                else:
-                    print("wrong msg")
-            elif args[0] == "migrate":
-                if len(args) == 5:
-                    command_migrate(args[1], args[2], args[3], int(args[4]))
-                else:
-                    print("wrong msg")
-            elif args[0] == "remove":
-                if len(args) == 4:
-                    command_remove(args[1], args[2], int(args[3]))
+            with self.changed:
+                ops = self.pending[key]
+                if len(ops) == 0:
+                    del self.pending[key]
+                    if key is None:
+                        self.barrier = False
+                    self.changed.notify_all()
+                    return
+                op = ops.popleft()
+                self.last_lag = time.monotonic() - op.enqueued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+            queue_wait.observe(self.last_lag)
+            if not op.future.set_running_or_notify_cancel():
+                self.slots.release()
+                continue
+            op.started_at = time.monotonic()
+            dispatch_context.op = op
+            if op.output is not None:
+                job_output.capture(op.output)
+            error = None
+            try:
+                result = execute_operation(op)
+            except Exception as e:
+                error = e
+            op.finished_at = time.monotonic()
+            # done callbacks (a job's completion line) run in this thread: stop capturing first
+            dispatch_context.op = None
+            if op.output is not None:
+                job_output.capture(None)
+            if error is None:
+                op.future.set_result(result)
+            else:
+                op.future.set_exception(error)
+            self.slots.release()
+
+    def depth(self):
+        with self.lock:
+            return sum(len(ops) for ops in self.pending.values())
+
+    def join(self):
+        with self.changed:
+            while len(self.pending) > 0:
+                self.changed.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.join()
+        self.pool.shutdown(wait=True)
+
+
+class JobOutput:
+    # sys.stdout of the interactive CLI: what a job prints from its dispatch worker is kept with
+    # the job (and shown in its completion line), everything else passes through
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+class JobTable:
+    # Interactive deploy/migrate/remove and the moves of rebalance are submitted to the
+    # dispatch queue as numbered jobs and the prompt returns at once; each job prints one line
+    # when it finishes. The last `keep` jobs stay listed for jobs/wait/cancel.
+    def __init__(self, keep):
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.next_id = 1
+        self.keep = keep
+
+    def submit(self, op):
+        op.PRINT = 1
+        op.output = []
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+        op.job = job_id
+        future = message_queue.submit(op)
+        with self.lock:
+            self.jobs[job_id] = op
+            finished = [old_id for old_id, old in self.jobs.items() if old.future.done()]
+            for old_id in finished[:max(0, len(self.jobs) - self.keep)]:
+                del self.jobs[old_id]
+        print(f"[job {job_id}] {op}")
+        future.add_done_callback(lambda future: print(f"\n[job {job_id}] {op}: {op.status()}"))
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def print_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.items())
+        if len(jobs) == 0:
+            print("No jobs.")
+            return
+        print(f"{'JOB':<6}{'OPERATION':<40}STATUS")
+        for job_id, op in jobs:
+            print(f"{job_id:<6}{str(op):<40}{op.status()}")
+
+    def wait(self, job_id):
+        if job_id is None:
+            with self.lock:
+                ops = [op for op in self.jobs.values() if not op.future.done()]
+        else:
+            op = self.get(job_id)
+            if op is None:
+                print(f"No job {job_id}.")
+                return
+            ops = [op]
+        try:
+            concurrent.futures.wait([op.future for op in ops])
+        except KeyboardInterrupt:
+            print("\nStopped waiting, the jobs keep running.")
+
+    def cancel(self, job_id):
+        op = self.get(job_id)
+        if op is None:
+            print(f"No job {job_id}.")
+        elif op.future.cancel():
+            print(f"Job {job_id} has been cancelled.")
+        elif op.future.done():
+            print(f"Job {job_id} has already finished.")
+        else:
+            op.stopped = True
+            print(f"Job {job_id} is running: a transfer in progress is stopped, other commands finish but are not retried.")
+
+
+
+def batch_operation(request):
+    # One JSONL request -> an Operation for the dispatch queue, or None for the commands
+    # (reprioritize, reconcile, show) that run in line once everything before them is done.
+    command = request.get("command")
+    name = request.get("name")
+    if command in ["deploy", "place"]:
+        if request.get("priority") not in PRIORITIES or (request.get("node") not in nodes and request.get("node") != "auto") \
+                or not name:
+            raise ValueError(f"{command} needs priority (low/medium/high), node ({'/'.join(nodes)}/auto) and name")
+        return Operation(command, name, priority=request["priority"], node=request["node"])
+    if command == "migrate":
+        if request.get("src") not in nodes or (request.get("dst") not in nodes and request.get("dst") != "auto") \
+                or not name:
+            raise ValueError(f"migrate needs src ({'/'.join(nodes)}), dst ({'/'.join(nodes)}/auto) and name")
+        kind = "migrate_stateful" if request.get("stateful") else "migrate"
+        return Operation(kind, name, src=request["src"], dst=request["dst"])
+    if command == "remove":
+        scope = request.get("scope", "container")
+        if scope not in ["container", "node"] or not name or (scope == "node" and name != "all" and name not in nodes):
+            raise ValueError("remove needs a container name, or scope node with a node or all")
+        return Operation("remove", name, scope=scope)
+    if command == "reprioritize":
+        if request.get("node") not in nodes or request.get("priority") not in PRIORITIES:
+            raise ValueError(f"reprioritize needs node ({'/'.join(nodes)}) and priority (low/medium/high)")
+        return None
+    if command == "show":
+        if request.get("content", "placement") not in ["placement", "deployment", "priority"]:
+            raise ValueError("show content is placement, deployment or priority")
+        return None
+    if command == "reconcile":
+        return None
+    raise ValueError(f"unknown command {command!r}")
+
+
+def run_batch_inline(request):
+    command = request["command"]
+    if command == "reprioritize":
+        return {"changed": reprioritize(request["node"], request["priority"], request.get("names"))}
+    if command == "reconcile":
+        reconciler.load_from_registry()
+        plan = reconciler.reconcile()
+        return {"plan": {node: {"removed": len(steps["remove"]),
+                                "updated": sum(len(names) for names in steps["update"].values()),
+                                "created": sum(len(names) for names in steps["create"].values()),
+                                "errors": steps["errors"]}
+                         for node, steps in plan.items()}}
+    content = request.get("content", "placement")
+    if content == "placement":
+        return {"placement": {name: {"node": node, "priority": priority} for name, node, priority in registry.snapshot()}}
+    rows = {}
+    for node in nodes:
+        backend = get_backend(node)
+        rows[node] = backend.ps() if content == "deployment" else backend.stats()
+    return {"rows": rows}
+
+
+def batch_result(request, number, status, start, error=None, data=None):
+    result = {"id": request.get("id", number), "command": request.get("command"), "status": status,
+              "elapsed_ms": round((time.monotonic() - start) * 1000, 3)}
+    name = request.get("name")
+    if name and request.get("scope", "container") == "container":
+        record = registry.get(name)
+        result["placement"] = None if record is None else {"node": record.node, "priority": record.priority}
+    if error is not None:
+        result["error"] = error
+    if data is not None:
+        result.update(data)
+    return result
+
+
+def run_batch(path):
+    # Reads JSONL requests from a file (or stdin for "-") and writes one JSON result line per
+    # request as it completes. Queued operations on different containers run concurrently.
+    output_lock = threading.Lock()
+
+    def emit(result):
+        with output_lock:
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+
+    def done(future, request, number, start):
+        if future.cancelled():
+            emit(batch_result(request, number, "superseded", start))
+        elif future.exception() is not None:
+            emit(batch_result(request, number, "error", start, error=str(future.exception())))
+        elif future.result() is False:
+            emit(batch_result(request, number, "error", start, error="not applied"))
+        else:
+            emit(batch_result(request, number, "ok", start))
+
+    recover_state(0)
+    source = sys.stdin if path == "-" else open(path)
+    try:
+        for number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            reload_image_config(0)
+            start = time.monotonic()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("a request is a JSON object")
+                op = batch_operation(request)
+            except ValueError as e:
+                emit({"id": number, "status": "invalid", "error": str(e)})
+                continue
+            if op is None:
+                message_queue.join()
+                try:
+                    emit(batch_result(request, number, "ok", start, data=run_batch_inline(request)))
+                except Exception as e:
+                    emit(batch_result(request, number, "error", start, error=str(e)))
+                continue
+            future = message_queue.submit(op)
+            future.add_done_callback(lambda future, request=request, number=number, start=start:
+                                     done(future, request, number, start))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    message_queue.join()
+
+
+def recover_state(PRINT):
+    # Rebuilds the registry from the state journal and checks it against one bulk listing per
+    # node: running containers are adopted as they are (also ones the journal missed), recorded
+    # ones that are gone are dropped. Unreachable nodes keep what the journal says. Standbys
+    # are only left over by a manager that did not get to clean up, and are removed.
+    start = time.monotonic()
+    recorded = state_journal.load() if state_journal is not None else {}
+    adopted = strays = lost = standbys = 0
+    for node, containers in reconciler.actual_state().items():
+        if containers is None:
+            registry.replace_node(node, [(name, priority) for name, (n, priority) in recorded.items() if n == node])
+            continue
+        leftover = [name for name in containers if name.startswith(STANDBY_PREFIX)]
+        if len(leftover) > 0 and get_backend(node).remove(leftover).ok():
+            standbys += len(leftover)
+        entries = []
+        for name, (cpu_shares, running, container_id) in containers.items():
+            if running and not name.startswith(STANDBY_PREFIX):
+                known = recorded.get(name)
+                if known is not None and known[0] == node:
+                    # the journaled priority wins: reprioritize writes cgroupfs and leaves docker's
+                    # CpuShares at the value the container was created with
+                    adopted += 1
+                    entries.append((name, known[1]))
                 else:
-                    print("wrong msg")
-            elif args[0] == "exit":
-                break
+                    strays += 1
+                    entries.append((name, priority_of_cpu_shares(cpu_shares) or "low"))
+        lost += sum(1 for name, (n, priority) in recorded.items()
+                    if n == node and not (name in containers and containers[name][1]))
+        registry.replace_node(node, entries)
+    if state_journal is not None:
+        state_journal.open()
+        registry.journal = state_journal
+        state_journal.compact(registry)
+    if PRINT == 1 and adopted + strays + lost + standbys > 0:
+        print(f"Recovered {adopted} containers from the state journal, adopted {strays} more running ones, "
+              f"dropped {lost} that are gone, removed {standbys} left-over standbys, "
+              f"in {(time.monotonic() - start) * 1000:.0f} ms.")
+
+
+def close_batch():
+    # containers placed by a batch stay where they are; only the connections are closed
+    message_queue.close()
+    if state_journal is not None:
+        state_journal.close()
+    for executor in executors.values():
+        executor.close()
 
-message_queue = MessageQueue()
 
 
 ########################################
@@ -567,64 +3958,241 @@ rx_pkt_local_cur = 0
 rx_pkt_remote_last = 0
 rx_pkt_remote_cur = 0
 
-config = read_config()
-remote_host = config["remote_host"]
-remote_user = config["remote_user"]
-local_interface = config["local_interface"]
-remote_interface = config["remote_interface"]
-priority_cpu_low = config["priority_cpu_low"]
-priority_mem_low = config["priority_mem_low"]
-priority_cpu_medium = config["priority_cpu_medium"]
-priority_mem_medium = config["priority_mem_medium"]
-priority_cpu_high = config["priority_cpu_high"]
-priority_mem_high = config["priority_mem_high"]
-image = config["image"]
-cal_period = int(config["cal_period"])
-throughput_low = int(config["throughput_low"])
-throughput_medium = int(config["throughput_medium"])
-throughput_high = int(config["throughput_high"])
-
-atexit.register(cleanup)
-
-print_welcome()
-
-t = threading.Thread(target=message_queue.process_messages)
-t.start()
-
-while True:
+
+def start(mode, argv):
+    # Builds the runtime state from config.ini. Outside replay, node capacities are measured
+    # here and recover_state then lists every node, in batch mode as well. Only the interactive
+    # mode prepares the image up front and fills the standby pool; in batch mode the image index
+    # queries a node the first time it is consulted.
+    global config, nodes, priority_cpu_low, priority_mem_low, priority_cpu_medium, priority_mem_medium, \
+        priority_cpu_high, priority_mem_high, image, cal_period, throughput_low, throughput_medium, throughput_high, \
+        hysteresis, min_dwell, dispatch_workers, dispatch_max_pending, placement_policy, executors, registry, \
+        state_journal, capacity_planner, rebalance_moves, \
+        docker_backend, docker_socket, docker_remote_socket, docker_forward_socket, docker_pool_size, \
+        docker_api_version, replay_speed, replay_duration, replay_patterns, replay_args, backends, agent_period, \
+        agent_python, agent_counters, agent_ring_size, migration_streams, migration_chunk_size, migration_timeout, \
+        config_mtime, \
+        image_index, standby_pool, cgroup_period, cgroup_collector, metrics, smoothers, forecast_method, \
+        forecast_lead_time, forecast_log_path, forecast_log, forecasters, trace_path, trace_recorder, \
+        event_list, dashboard, message_queue, reconciler, job_retries, job_backoff, job_deadline, job_table, \
+        job_output
+    config = read_config()
+    nodes = config["nodes"]
+    priority_cpu_low = config["priority_cpu_low"]
+    priority_mem_low = config["priority_mem_low"]
+    priority_cpu_medium = config["priority_cpu_medium"]
+    priority_mem_medium = config["priority_mem_medium"]
+    priority_cpu_high = config["priority_cpu_high"]
+    priority_mem_high = config["priority_mem_high"]
+    image = config["image"]
+    cal_period = float(config["cal_period"])
+    throughput_low = int(config["throughput_low"])
+    throughput_medium = int(config["throughput_medium"])
+    throughput_high = int(config["throughput_high"])
+    hysteresis = float(config["hysteresis"])
+    min_dwell = float(config["min_dwell"])
+    dispatch_workers = int(config["dispatch_workers"])
+    dispatch_max_pending = int(config["dispatch_max_pending"])
+    job_retries = int(config["job_retries"])
+    job_backoff = float(config["job_backoff"])
+    job_deadline = float(config["job_deadline"])
+    policy_rules = config["services"] if len(config["services"]) > 0 else default_policy_rules()
+    placement_policy = PlacementPolicy([(name, {node: PlacementPolicy.parse_tiers(tiers) for node, tiers in rules.items()})
+                                        for name, rules in policy_rules])
+
+    executors = {}
+    for node, info in nodes.items():
+        if info["host"] != "local" and mode != "replay":
+            executors[node] = RemoteExecutor(info["user"], info["host"], config["ssh_control_path"],
+                                             int(config["ssh_persist"]), float(config["ssh_timeout"]))
+    registry = ContainerRegistry(nodes)
+    state_journal = None
+    if mode != "replay" and config["state_journal"]:
+        state_journal = StateJournal(config["state_journal"], config["state_snapshot"],
+                                     int(config["state_snapshot_every"]), config["state_fsync"] in ["yes", "true", "1"])
+    capacity_planner = CapacityPlanner(config["capacity_nodes"], float(config["cpu_overcommit"]),
+                                       float(config["memory_overcommit"]), mode != "replay")
+    rebalance_moves = int(config["rebalance_moves"])
+    if mode != "replay":
+        for node in capacity_planner.discover_all():
+            if mode == "interactive":
+                print(f"Capacity of node [{node}] could not be measured, no container is placed there automatically.")
+
+    docker_backend = config["docker_backend"]
+    docker_socket = config["docker_socket"]
+    docker_remote_socket = config["docker_remote_socket"]
+    docker_forward_socket = config["docker_forward_socket"]
+    docker_pool_size = int(config["docker_pool_size"])
+    docker_api_version = config["docker_api_version"]
+    replay_speed = float(config["replay_speed"])
+    replay_duration = float(config["replay_duration"])
+    replay_patterns = config["replay_patterns"]
+    if mode == "replay":
+        replay_args = parse_replay_args(argv)
+        replay_speed = replay_args["speed"] or replay_speed
+        backends = {node: TimedBackend(node, SimulatedBackend(config["replay_latencies"], replay_speed)) for node in nodes}
+    else:
+        backends = {node: TimedBackend(node, create_backend(node)) for node in nodes}
+
+    agent_period = float(config["agent_period"])
+    agent_python = config["agent_python"]
+    agent_counters = config["agent_counters"].split(",")
+    if "rx_packets" not in agent_counters:
+        agent_counters.insert(0, "rx_packets")
+    agent_ring_size = int(config["agent_ring_size"])
+    migration_streams = int(config["migration_streams"])
+    migration_chunk_size = int(config["migration_chunk_size"])
+    migration_timeout = float(config["migration_timeout"])
+
+    config_mtime = os.path.getmtime("config.ini")
+    if mode == "replay":
+        image_index = ImageIndex("off", "allow")
+        image_index.assume(image)
+        standby_pool = StandbyPool(0, [])
+    else:
+        image_index = ImageIndex(config["image_prepare"], config["image_cold_pull"])
+        standby_pool = StandbyPool(int(config["standby_size"]), config["standby_priorities"].split(","))
+    if mode == "interactive":
+        image_index.prepare(image, 1)
+
+    cgroup_period = float(config["cgroup_period"])
+    cgroup_collector = CgroupCollector(config["cgroup_root"])
+
+    metrics = {}
+    smoothers = {}
+    for node, info in nodes.items():
+        if node in executors:
+            metrics[node] = RemoteMetricsStream(node, info["interface"].split(","), agent_counters, agent_period,
+                                                agent_ring_size, executors[node], agent_python)
+        else:
+            metrics[node] = LocalMetricsStream(node, info["interface"].split(","), agent_counters, agent_period,
+                                               agent_ring_size)
+        smoothers[node] = RateSmoother(metrics[node], config["smoothing"], float(config["ewma_alpha"]),
+                                       float(config["smoothing_window"]), float(config["smoothing_percentile"]))
+
+    forecast_method = config["forecast_method"]
+    forecast_lead_time = float(config["forecast_lead_time"])
+    forecast_log_path = config["forecast_log"]
+    forecast_log = None
+    forecasters = {node: Forecaster(node, forecast_method, int(config["forecast_window"]),
+                                    max(1, round(forecast_lead_time / cal_period)),
+                                    float(config["forecast_alpha"]), float(config["forecast_beta"])) for node in nodes}
+
+    event_list = EventList(int(config["dashboard_events"]))
+    dashboard = Dashboard(sys.stdout)
+
+    trace_path = config["record_path"]
+    trace_recorder = TraceRecorder(trace_path, int(config["record_max_bytes"]), int(config["record_keep"]))
+
+    message_queue = MessageQueue(dispatch_workers, dispatch_max_pending)
+    job_table = JobTable(int(config["job_keep"]))
+    job_output = JobOutput(sys.stdout)
+    if mode == "interactive":
+        sys.stdout = job_output
+    reconciler = Reconciler()
+    if mode != "replay" and config["stats_port"] > 0:
+        start_metrics_server(config["stats_address"], config["stats_port"])
+
+
+def wait_for_jobs():
+    depth = message_queue.depth()
+    if depth > 0:
+        print(f"Waiting for {depth} queued operation(s) to finish first.")
+    try:
+        message_queue.join()
+    except KeyboardInterrupt:
+        print("\nStopped waiting, the command was not run.")
+        return False
+    return True
+
+
+def repl():
+    while True:
     
-    user_input = get_input()
-    if user_input == -1:
-        continue
+        user_input = get_input()
+        if user_input == -1:
+            continue
+        reload_image_config()
     
-    start_time = datetime.datetime.now()
-    if user_input["command"] == "deploy":   
-        command_deploy(user_input["priority"], user_input["node"], user_input["name"], 1)
-        # message_queue.insert_message("deploy "+user_input["priority"]+" "+user_input["node"]+" "+user_input["name"]+" 1")
+        start_time = datetime.datetime.now()
+        if user_input["command"] == "deploy":   
+            job_table.submit(Operation("deploy", user_input["name"], priority=user_input["priority"], node=user_input["node"]))
     
-    elif user_input["command"] == "migrate":
-        command_migrate(user_input["src"], user_input["dst"], user_input["name"], 1)
-        # message_queue.insert_message("migrate "+user_input["src"]+" "+user_input["dst"]+" "+user_input["name"]+" 1")
+        elif user_input["command"] == "migrate":
+            kind = "migrate_stateful" if user_input["stateful"] else "migrate"
+            job_table.submit(Operation(kind, user_input["name"], src=user_input["src"], dst=user_input["dst"]))
         
-    elif user_input["command"] == "deploy_auto":
-        command_deploy_auto()
+        elif user_input["command"] == "deploy_auto":
+            command_deploy_auto()
     
-    elif user_input["command"] == "show":
-        command_show(user_input["content"])
+        elif user_input["command"] == "show":
+            command_show(user_input["content"])
         
-    elif user_input["command"] == "remove":
-        command_remove(user_input["scope"], user_input["name"], 1)
-        # message_queue.insert_message("remove "+user_input["scope"]+" "+user_input["name"]+" 1")
+        elif user_input["command"] == "remove":
+            job_table.submit(Operation("remove", user_input["name"], scope=user_input["scope"]))
+
+        elif user_input["command"] == "jobs":
+            job_table.print_jobs()
+
+        elif user_input["command"] == "wait":
+            job_table.wait(user_input["job"])
+
+        elif user_input["command"] == "cancel":
+            job_table.cancel(user_input["job"])
         
-    elif user_input["command"] == "test":
-        message_queue.insert_message("migrate 2 1 " + name1 + " 1")
-            # command_deploy("low", "1", name1, 0)
-        message_queue.insert_message("deploy low 1 " + name1 + " 1")
+        elif user_input["command"] in ["reprioritize", "reconcile", "rebalance"]:
+            # these work on the registry and the nodes as the queued jobs leave them
+            if not wait_for_jobs():
+                continue
+            if user_input["command"] == "reprioritize":
+                command_reprioritize(user_input["node"], user_input["priority"], user_input["names"], 1)
+            elif user_input["command"] == "reconcile":
+                command_reconcile(1)
+            else:
+                command_rebalance(user_input["moves"], 1)
+
+        elif user_input["command"] == "test":
+            name = placement_policy.names[0]
+            message_queue.submit(Operation("migrate", name, src="2", dst="1", PRINT=1))
+                # command_deploy("low", "1", name1, 0)
+            message_queue.submit(Operation("deploy", name, priority="low", node="1", PRINT=1))
 
 
-    end_time = datetime.datetime.now()
-    elapsed_time = end_time - start_time
-    elapsed_microseconds = int(elapsed_time.total_seconds() * 1000000)
-    elapsed_time_str = f"{elapsed_microseconds // 1000000}.{elapsed_microseconds % 1000000:06d}"
+        end_time = datetime.datetime.now()
+        elapsed_time = end_time - start_time
+        elapsed_microseconds = int(elapsed_time.total_seconds() * 1000000)
+        elapsed_time_str = f"{elapsed_microseconds // 1000000}.{elapsed_microseconds % 1000000:06d}"
     
-    print(f"\ntime elapsed: {elapsed_time_str} s")
\ No newline at end of file
+        print(f"\ntime elapsed: {elapsed_time_str} s")
+
+
+def main(argv):
+    if "--agent" in argv:
+        run_agent(argv)
+        return
+    if "--reassemble" in argv:
+        run_reassemble(argv)
+        return
+    if "--replay" in argv:
+        start("replay", argv)
+        run_replay(replay_args)
+        message_queue.close()
+        return
+    if "--batch" in argv:
+        start("batch", argv)
+        atexit.register(close_batch)
+        run_batch(argv[argv.index("--batch") + 1] if argv.index("--batch") + 1 < len(argv) else "-")
+        return
+
+    start("interactive", argv)
+    setup_readline()
+    atexit.register(cleanup)
+    recover_state(1)
+    # after recover_state, which removes the standbys a previous run may have left
+    standby_pool.refill()
+    print_welcome()
+    repl()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,84 @@
+import pytest
+
+import manager
+
+
+@pytest.fixture
+def planner(monkeypatch):
+    for priority, cpu, mem in [("low", "256", "128M"), ("medium", "512", "256M"), ("high", "1024", "512M")]:
+        monkeypatch.setattr(manager, f"priority_cpu_{priority}", cpu, raising=False)
+        monkeypatch.setattr(manager, f"priority_mem_{priority}", mem, raising=False)
+    monkeypatch.setattr(manager, "nodes", {"1": None, "2": None, "3": None}, raising=False)
+    monkeypatch.setattr(manager, "registry", manager.ContainerRegistry(manager.nodes), raising=False)
+    configured = {node: (2048, 2 * 1024 ** 3) for node in manager.nodes}
+    return manager.CapacityPlanner(configured, 1.0, 1.0, False)
+
+
+def test_reserve_picks_least_loaded_node(planner):
+    manager.registry.insert("a", "1", "high")
+    manager.registry.insert("b", "2", "low")
+    assert planner.reserve("c", "medium") == "3"
+    # the reservation counts until the container is in the registry
+    assert planner.reserve("d", "high") == "2"
+    planner.release("c")
+    assert planner.reserve("e", "medium", exclude_node="2") == "3"
+
+
+def test_reserve_returns_none_when_nothing_fits(planner):
+    for node in manager.nodes:
+        manager.registry.insert(f"{node}a", node, "high")
+        manager.registry.insert(f"{node}b", node, "high" if node != "3" else "medium")
+    assert planner.fits("1", "low") is False
+    assert planner.fits("3", "medium") is True
+    assert planner.reserve("x", "high") is None
+    assert planner.reserve("x", "low") == "3"
+
+
+def test_rebalance_moves_off_the_busiest_node(planner):
+    manager.registry.insert("a", "1", "high")
+    manager.registry.insert("b", "1", "medium")
+    manager.registry.insert("c", "1", "low")
+    # once "a" is on node 2 that is the peak, and moving it on gains nothing
+    assert planner.rebalance(5) == [("a", "1", "2")]
+    # the moves are only a plan
+    assert manager.registry.names("1") == ["a", "b", "c"]
+
+
+def test_rebalance_leaves_pinned_and_balanced_containers(planner):
+    manager.registry.insert("a", "1", "high")
+    manager.registry.insert("b", "1", "medium")
+    assert planner.rebalance(5, pinned=("a",)) == [("b", "1", "2")]
+    manager.registry.insert("b", "2", "medium")
+    manager.registry.insert("c", "3", "medium")
+    assert planner.rebalance(5) == []
+
+
+def test_unmeasured_node_gets_nothing_and_is_probed_once(planner, monkeypatch):
+    calls = []
+
+    def node_run(node, cmd):
+        calls.append(node)
+        if node == "3":
+            return manager.CommandResult(255, b"", b"ssh: connect to host: Connection timed out", 30.0)
+        return manager.CommandResult(0, b"2048 2097152\n", b"", 0.01)
+
+    monkeypatch.setattr(manager, "node_run", node_run)
+    planner.configured = {}
+    planner.discover = True
+    assert planner.discover_all() == ["3"]
+    manager.registry.insert("a", "1", "high")
+    manager.registry.insert("b", "1", "medium")
+    manager.registry.insert("c", "3", "high")
+    assert planner.reserve("d", "low") == "2"
+    assert planner.rebalance(5) == [("b", "1", "2")]
+    assert sorted(calls) == ["1", "2", "3"]
+
+
+def test_rebalance_counts_pending_placements(planner):
+    manager.registry.insert("a", "1", "high")
+    manager.registry.insert("b", "1", "medium")
+    manager.registry.insert("p", "1", "high")
+    # "p" is pinned and about to leave node 1 for node 2, "q" is about to arrive on node 3
+    pending = {"p": ("2", "high"), "q": ("3", "high")}
+    assert planner.rebalance(5, pinned=("p", "q"), pending=pending) == []
+    assert planner.rebalance(5, pinned=("p", "q")) == [("a", "1", "2"), ("b", "1", "3")]
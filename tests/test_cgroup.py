@@ -0,0 +1,91 @@
+import pytest
+
+import manager
+
+MANAGED = "a" * 64
+OTHER = "b" * 64
+
+
+def write_cgroup(path, usage_usec, weight=100, current=1048576, maximum="max"):
+    path.mkdir(parents=True)
+    (path / "cpu.stat").write_text(f"usage_usec {usage_usec}\nuser_usec 0\nsystem_usec 0\n")
+    (path / "cpu.weight").write_text(f"{weight}\n")
+    (path / "memory.current").write_text(f"{current}\n")
+    (path / "memory.max").write_text(f"{maximum}\n")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    write_cgroup(tmp_path / "system.slice" / f"docker-{MANAGED}.scope", 1000000, weight=20,
+                 current=1048576, maximum="4194304")
+    write_cgroup(tmp_path / "docker" / OTHER, 0)
+    # not a container: no cpu.stat
+    (tmp_path / "system.slice" / "docker-socket.scope").mkdir()
+    return tmp_path
+
+
+class ListingBackend:
+    def __init__(self, containers):
+        self.containers = containers
+        self.calls = 0
+
+    def list(self):
+        self.calls += 1
+        return self.containers
+
+
+@pytest.fixture
+def collector(tree, monkeypatch):
+    backend = ListingBackend({"service_entry_A": (512, True, MANAGED)})
+    monkeypatch.setattr(manager, "nodes", {"1": None}, raising=False)
+    monkeypatch.setattr(manager, "executors", {}, raising=False)
+    monkeypatch.setattr(manager, "backends", {"1": backend}, raising=False)
+    collector = manager.CgroupCollector(str(tree))
+    collector.backend = backend
+    return collector
+
+
+def test_read_cgroup_tree(tree):
+    ts, containers = manager.read_cgroup_tree(str(tree))
+    assert ts > 0
+    assert containers == {
+        MANAGED: {"usage_usec": 1000000, "cpu_weight": 20, "memory_current": 1048576, "memory_max": 4194304},
+        OTHER: {"usage_usec": 0, "cpu_weight": 100, "memory_current": 1048576, "memory_max": None},
+    }
+
+
+def test_parse_cgroup_tree_output_matches_local_read(tree):
+    output = "123.45 678.90\n"
+    for path, cgroup in [(tree / "system.slice" / f"docker-{MANAGED}.scope", MANAGED), (tree / "docker" / OTHER, OTHER)]:
+        output += f"@@ {path}\n"
+        for name in manager.CGROUP_FILES:
+            output += f"== {name}\n" + (path / name).read_text()
+    ts, containers = manager.parse_cgroup_tree_output(output)
+    assert ts == 123.45
+    assert containers == manager.read_cgroup_tree(str(tree))[1]
+
+
+def test_collect_rates_from_usage_deltas(tree, collector, monkeypatch):
+    # a fixed clock instead of /proc/uptime
+    read = manager.read_cgroup_tree
+    times = iter([100.0, 102.0])
+    monkeypatch.setattr(manager, "read_cgroup_tree", lambda root: (next(times), read(root)[1]))
+    stats = collector.collect("1")
+    assert set(stats) == {"service_entry_A"}
+    assert stats["service_entry_A"]["cpu_percent"] is None
+    assert stats["service_entry_A"]["memory_percent"] == 25
+    (tree / "system.slice" / f"docker-{MANAGED}.scope" / "cpu.stat").write_text("usage_usec 2000000\n")
+    stats = collector.collect("1")
+    assert stats["service_entry_A"]["cpu_percent"] == 50
+    assert collector.get("1", "service_entry_A") == stats["service_entry_A"]
+
+
+def test_unmanaged_cgroups_are_listed_once(tree, collector):
+    collector.collect("1")
+    collector.collect("1")
+    assert collector.backend.calls == 1
+    new = "c" * 64
+    write_cgroup(tree / "docker" / new, 0)
+    collector.backend.containers["service_entry_B"] = (1024, True, new)
+    assert set(collector.collect("1")) == {"service_entry_A", "service_entry_B"}
+    assert collector.backend.calls == 2
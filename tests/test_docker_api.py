@@ -0,0 +1,235 @@
+import http.server
+import json
+import os
+import socket
+import socketserver
+import threading
+import urllib.parse
+
+import pytest
+
+import manager
+
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    # the handful of Engine API endpoints DockerAPIBackend uses, backed by server.containers
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        server = self.server
+        with server.lock:
+            server.requests.append((method, url.path, params))
+            server.connections.add(self.connection.fileno())
+            server.sockets.add(self.connection)
+            parts = url.path.strip("/").split("/")
+            containers = server.containers
+            if url.path in server.failures:
+                return self.reply(500, {"message": server.failures[url.path]})
+            if method == "POST" and url.path == "/containers/create":
+                if body["Image"] not in server.images:
+                    return self.reply(404, {"message": f"No such image: {body['Image']}"})
+                container_id = f"{len(server.requests):064x}"
+                containers[params["name"]] = {"Id": container_id, "Name": "/" + params["name"], "Body": body,
+                                              "HostConfig": dict(body["HostConfig"]), "State": {"Running": False}}
+                return self.reply(201, {"Id": container_id, "Warnings": []})
+            if method == "POST" and url.path == "/images/create":
+                server.images.add(f"{params['fromImage']}:{params['tag']}")
+                return self.reply(200, {})
+            if method == "GET" and url.path == "/containers/json":
+                return self.reply(200, [{"Id": c["Id"], "Names": [c["Name"]]} for c in containers.values()])
+            if parts[0] == "containers" and len(parts) >= 2:
+                name = parts[1]
+                container = containers.get(name) or next((c for c in containers.values() if c["Id"] == name), None)
+                if container is None:
+                    return self.reply(404, {"message": f"No such container: {name}"})
+                if method == "DELETE":
+                    del containers[container["Name"].lstrip("/")]
+                    return self.reply(204)
+                if method == "GET" and parts[2:] == ["json"]:
+                    return self.reply(200, container)
+                if method == "POST" and parts[2:] == ["start"]:
+                    container["State"]["Running"] = True
+                    return self.reply(204)
+                if method == "POST" and parts[2:] == ["update"]:
+                    container["HostConfig"]["CpuShares"] = body["CpuShares"]
+                    container["HostConfig"]["Memory"] = body["Memory"]
+                    return self.reply(200, {"Warnings": []})
+            return self.reply(400, {"message": f"unexpected {method} {url.path}"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_dockerd(path):
+    server = FakeDockerServer(path, FakeDockerHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.connections = set()
+    server.sockets = set()
+    server.containers = {}
+    server.images = {"app:latest"}
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    return server
+
+
+def stop_dockerd(server):
+    server.shutdown()
+    server.server_close()
+    for sock in server.sockets:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def dockerd(tmp_path):
+    server = start_dockerd(str(tmp_path / "docker.sock"))
+    yield server
+    stop_dockerd(server)
+
+
+@pytest.fixture
+def backend(dockerd):
+    client = manager.DockerAPIClient(dockerd.server_address, pool_size=2, timeout=5)
+    yield manager.DockerAPIBackend(client)
+    client.close()
+
+
+def test_run_creates_and_starts(dockerd, backend):
+    result = backend.run("service_entry_A", "512", "128M", "app:latest")
+    assert result.ok()
+    container = dockerd.containers["service_entry_A"]
+    assert container["State"]["Running"]
+    assert container["HostConfig"]["CpuShares"] == 512
+    assert container["HostConfig"]["Memory"] == 128 * 1024 * 1024
+    assert container["Body"]["Labels"] == {"container_manager": "1"}
+
+
+def test_run_pulls_missing_image(dockerd, backend):
+    assert backend.run("service_entry_A", "512", "128M", "registry:5000/app:v2").ok()
+    assert ("POST", "/images/create", {"fromImage": "registry:5000/app", "tag": "v2"}) in dockerd.requests
+    assert dockerd.containers["service_entry_A"]["State"]["Running"]
+
+
+def test_requests_reuse_one_connection(dockerd, backend):
+    for name in ["a", "b", "c"]:
+        assert backend.run(name, "512", "128M", "app:latest").ok()
+    assert len(dockerd.connections) == 1
+
+
+def test_api_error_becomes_result(dockerd, backend):
+    result = backend.update("missing", "512", "128M")
+    assert result.returncode == 404
+    assert b"No such container" in result.stderr
+
+
+def test_remove_ignores_missing_containers(dockerd, backend):
+    backend.run("a", "512", "128M", "app:latest")
+    result = backend.remove(["gone", "a"])
+    assert result.ok()
+    assert dockerd.containers == {}
+
+
+def test_remove_reports_first_failure(dockerd, backend):
+    for name in ["a", "b", "c"]:
+        backend.run(name, "512", "128M", "app:latest")
+    dockerd.failures["/containers/b"] = "device busy"
+    result = backend.remove(["a", "b", "c"])
+    assert result.returncode == 500
+    assert result.stderr == b"device busy"
+    assert set(dockerd.containers) == {"b"}
+
+
+def test_update_many_reports_first_failure(dockerd, backend):
+    backend.run("a", "512", "128M", "app:latest")
+    result = backend.update_many(["a", "missing"], "1024", "256M")
+    assert result.returncode == 404
+    assert dockerd.containers["a"]["HostConfig"]["CpuShares"] == 1024
+
+
+def test_list_inspects_every_container(dockerd, backend):
+    backend.run("a", "512", "128M", "app:latest")
+    backend.run("b", "1024", "128M", "app:latest")
+    containers = backend.list()
+    assert containers == {"a": (512, True, dockerd.containers["a"]["Id"]),
+                          "b": (1024, True, dockerd.containers["b"]["Id"])}
+
+
+def test_unreachable_socket_fails_like_a_timeout(tmp_path):
+    backend = manager.DockerAPIBackend(manager.DockerAPIClient(str(tmp_path / "missing.sock"), timeout=1))
+    result = backend.update("a", "512", "128M")
+    assert result.returncode == -1
+
+
+def test_missing_socket_is_restored_once(tmp_path):
+    path = str(tmp_path / "forward.sock")
+    servers = []
+
+    def reconnect():
+        if os.path.exists(path):
+            os.unlink(path)
+        servers.append(start_dockerd(path))
+        return True
+
+    client = manager.DockerAPIClient(path, timeout=5, reconnect=reconnect)
+    backend = manager.DockerAPIBackend(client)
+    try:
+        assert backend.run("a", "512", "128M", "app:latest").ok()
+        assert backend.update("a", "1024", "128M").ok()
+        assert len(servers) == 1
+        # the forward goes away and leaves a socket file nobody listens on
+        stop_dockerd(servers[0])
+        servers[0].containers.clear()
+        assert backend.run("b", "512", "128M", "app:latest").ok()
+        assert len(servers) == 2
+    finally:
+        client.close()
+        stop_dockerd(servers[-1])
+
+
+def test_socket_that_can_not_be_restored_fails(tmp_path):
+    calls = []
+    client = manager.DockerAPIClient(str(tmp_path / "forward.sock"), timeout=1,
+                                     reconnect=lambda: calls.append(1) or False)
+    assert manager.DockerAPIBackend(client).update("a", "512", "128M").returncode == -1
+    assert calls == [1]
+
+
+@pytest.mark.parametrize("ref, expected", [
+    ("app", ("app", "latest")),
+    ("app:v2", ("app", "v2")),
+    ("registry:5000/app", ("registry:5000/app", "latest")),
+    ("registry:5000/team/app:v2", ("registry:5000/team/app", "v2")),
+    ("app@sha256:abc", ("app", "sha256:abc")),
+])
+def test_split_image(ref, expected):
+    assert manager.split_image(ref) == expected
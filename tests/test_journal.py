@@ -0,0 +1,32 @@
+import json
+
+import manager
+
+
+def make_journal(tmp_path, snapshot_every=100):
+    return manager.StateJournal(str(tmp_path / "state.journal"), str(tmp_path / "state.snapshot"), snapshot_every, False)
+
+
+def test_load_skips_torn_last_line(tmp_path):
+    entries = [{"op": "set", "name": "a", "node": "1", "priority": "low"},
+               {"op": "set", "name": "b", "node": "2", "priority": "high"},
+               {"op": "del", "name": "a"}]
+    lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+    (tmp_path / "state.journal").write_text(lines + '{"op": "set", "name": "c", "no')
+    assert make_journal(tmp_path).load() == {"b": ("2", "high")}
+
+
+def test_registry_changes_survive_compaction(tmp_path):
+    journal = make_journal(tmp_path, snapshot_every=3)
+    journal.open()
+    registry = manager.ContainerRegistry(["1", "2"])
+    registry.journal = journal
+    registry.insert("a", "1", "low")
+    registry.insert("b", "2", "medium")
+    registry.update_priority("a", "high")
+    # the third entry compacted the log into the snapshot
+    assert (tmp_path / "state.journal").read_text() == ""
+    registry.delete("b")
+    registry.insert("c", "2", "low")
+    journal.close()
+    assert make_journal(tmp_path).load() == {"a": ("1", "high"), "c": ("2", "low")}
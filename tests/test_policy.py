@@ -0,0 +1,59 @@
+import pytest
+
+import manager
+
+RULES = [("service_entry_A", {"1": "100:1:low, 1000:1:medium, inf:1:high"}),
+         ("service_entry_B", {"1": "500:off, inf:2:high", "2": "100:2:low, inf:keep"})]
+
+
+def make_policy(monkeypatch, hysteresis=0.0, min_dwell=0.0):
+    monkeypatch.setattr(manager, "hysteresis", hysteresis, raising=False)
+    monkeypatch.setattr(manager, "min_dwell", min_dwell, raising=False)
+    return manager.PlacementPolicy([(name, {node: manager.PlacementPolicy.parse_tiers(tiers)
+                                            for node, tiers in rules.items()}) for name, rules in RULES])
+
+
+def test_parse_tiers():
+    assert manager.PlacementPolicy.parse_tiers("50:keep, 10:1:low") == \
+        [(10, ("1", "low")), (50, "keep"), (float("inf"), "keep")]
+
+
+def test_decides_only_with_one_traffic_source(monkeypatch):
+    policy = make_policy(monkeypatch)
+    assert policy.evaluate({"1": 0, "2": 0}, 0) == []
+    assert policy.evaluate({"1": 50, "2": 50}, 0) == []
+
+
+def test_moves_between_tiers(monkeypatch):
+    policy = make_policy(monkeypatch)
+    assert policy.evaluate({"1": 50, "2": 0}, 0) == [("service_entry_A", None, ("1", "low"))]
+    assert policy.evaluate({"1": 50, "2": 0}, 1) == []
+    assert policy.evaluate({"1": 600, "2": 0}, 2) == [("service_entry_A", ("1", "low"), ("1", "medium")),
+                                                      ("service_entry_B", None, ("2", "high"))]
+    assert policy.evaluate({"1": 200, "2": 0}, 3) == [("service_entry_B", ("2", "high"), None)]
+
+
+def test_keep_leaves_placement(monkeypatch):
+    policy = make_policy(monkeypatch)
+    assert policy.evaluate({"1": 0, "2": 50}, 0) == [("service_entry_B", None, ("2", "low"))]
+    assert policy.evaluate({"1": 0, "2": 5000}, 1) == []
+    assert policy.targets({"1": 0, "2": 5000}) == {}
+    assert policy.targets({"1": 5000, "2": 0}) == {"service_entry_A": ("1", "high"), "service_entry_B": ("2", "high")}
+
+
+def test_hysteresis_holds_the_current_tier(monkeypatch):
+    policy = make_policy(monkeypatch, hysteresis=0.1)
+    policy.evaluate({"1": 600}, 0)
+    assert policy.evaluate({"1": 1050}, 1) == []
+    # service_entry_A stays medium just below 100; service_entry_B is far below 500
+    assert policy.evaluate({"1": 95}, 2) == [("service_entry_B", ("2", "high"), None)]
+    assert policy.evaluate({"1": 1200}, 3) == [("service_entry_A", ("1", "medium"), ("1", "high")),
+                                               ("service_entry_B", None, ("2", "high"))]
+
+
+@pytest.mark.parametrize("now, moved", [(5, False), (10, True)])
+def test_min_dwell(monkeypatch, now, moved):
+    policy = make_policy(monkeypatch, min_dwell=10)
+    policy.evaluate({"1": 50}, 0)
+    decisions = policy.evaluate({"1": 200}, now)
+    assert decisions == ([("service_entry_A", ("1", "low"), ("1", "medium"))] if moved else [])
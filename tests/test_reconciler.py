@@ -0,0 +1,75 @@
+import pytest
+
+import manager
+
+SHARES = {"low": 256, "medium": 512, "high": 1024}
+
+
+class FakeBackend:
+    # containers: name -> [cpu_shares, running]; names in fail are refused by run and update
+    def __init__(self, containers=None, fail=()):
+        self.containers = {name: list(values) for name, values in (containers or {}).items()}
+        self.fail = set(fail)
+
+    @staticmethod
+    def result(failed):
+        if failed:
+            return manager.CommandResult(1, b"", f"Error: {failed[0]} refused".encode(), 0.01)
+        return manager.CommandResult(0, b"", b"", 0.01)
+
+    def list(self):
+        return {name: (cpu, running, f"id{name}") for name, (cpu, running) in self.containers.items()}
+
+    def remove(self, names):
+        for name in names:
+            self.containers.pop(name, None)
+        return self.result([])
+
+    def update_many(self, names, cpu, mem):
+        for name in names:
+            if name not in self.fail:
+                self.containers[name][0] = int(cpu)
+        return self.result([name for name in names if name in self.fail])
+
+    def run_many(self, specs, image):
+        for name, cpu, mem in specs:
+            if name not in self.fail:
+                self.containers[name] = [int(cpu), True]
+        return self.result([name for name, cpu, mem in specs if name in self.fail])
+
+
+@pytest.fixture
+def reconciler(monkeypatch):
+    for priority, cpu in SHARES.items():
+        monkeypatch.setattr(manager, f"priority_cpu_{priority}", str(cpu), raising=False)
+        monkeypatch.setattr(manager, f"priority_mem_{priority}", "128m", raising=False)
+    monkeypatch.setattr(manager, "image", "app:latest", raising=False)
+    monkeypatch.setattr(manager, "nodes", {"1": None, "2": None}, raising=False)
+    monkeypatch.setattr(manager, "registry", manager.ContainerRegistry(manager.nodes), raising=False)
+    return manager.Reconciler()
+
+
+def test_converges_to_desired(reconciler, monkeypatch):
+    backends = {"1": FakeBackend({"a": (256, True), "stray": (256, True), "cm-standby-low-x": (256, False)}),
+                "2": FakeBackend({"b": (256, True)})}
+    monkeypatch.setattr(manager, "backends", backends, raising=False)
+    reconciler.set("a", "1", "high")
+    reconciler.set("b", "1", "low")
+    reconciler.set("c", "2", "medium")
+    plan = reconciler.reconcile()
+    assert plan["1"] == {"remove": ["stray"], "update": {"high": ["a"]}, "create": {"low": ["b"]}, "errors": []}
+    assert plan["2"] == {"remove": ["b"], "update": {}, "create": {"medium": ["c"]}, "errors": []}
+    assert backends["1"].containers == {"a": [1024, True], "b": [256, True], "cm-standby-low-x": [256, False]}
+    assert sorted(manager.registry.snapshot()) == [("a", "1", "high"), ("b", "1", "low"), ("c", "2", "medium")]
+
+
+def test_failed_steps_are_not_recorded(reconciler, monkeypatch):
+    backends = {"1": FakeBackend({"a": (256, True)}, fail=["a", "bad"]), "2": FakeBackend()}
+    monkeypatch.setattr(manager, "backends", backends, raising=False)
+    reconciler.set("a", "1", "high")
+    reconciler.set("bad", "1", "low")
+    reconciler.set("good", "1", "low")
+    plan = reconciler.reconcile()
+    assert plan["1"]["errors"] == ["docker update: Error: a refused", "docker run: Error: bad refused"]
+    # "a" keeps the priority it really has, "bad" was never created
+    assert sorted(manager.registry.snapshot()) == [("a", "1", "low"), ("good", "1", "low")]
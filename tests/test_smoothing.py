@@ -0,0 +1,31 @@
+import manager
+
+
+class FakeStream:
+    def __init__(self, rates):
+        self.samples = list(rates)
+        self.seen = []
+
+    def rate(self, counter, period):
+        self.seen.append(self.samples.pop(0))
+        return self.seen[-1]
+
+    def rates(self, counter, window):
+        return self.seen[-3:]
+
+
+def smoothed(mode, rates):
+    smoother = manager.RateSmoother(FakeStream(rates), mode, 0.5, 3, 50)
+    return [smoother.rate(1) for rate in rates]
+
+
+def test_ewma_reads_zero_once_traffic_stops_and_restarts_from_the_next_sample():
+    assert smoothed("ewma", [100, 200, 0, 400, 0]) == [100, 150, 0, 400, 0]
+
+
+def test_percentile_reads_zero_once_traffic_stops():
+    assert smoothed("percentile", [100, 300, 200, 0, 500]) == [100, 300, 200, 0, 200]
+
+
+def test_none_passes_the_raw_rate():
+    assert smoothed("none", [100, 0, 50]) == [100, 0, 50]